@@ -1,6 +1,17 @@
 import time
 import os
+import hashlib
+import re
 import logging
+import mmap
+import sys
+import queue
+import sqlite3
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
@@ -8,82 +19,1638 @@ from yaml import safe_load
 from flow.flow import FlowDiagram
 from .base_listener import BaseListener
 
+try:
+    # Hash non crittografico veloce per le impronte del contenuto (opzionale)
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    # Su Linux l'observer predefinito è basato su inotify e genera gli eventi
+    # di chiusura (IN_CLOSE_WRITE) necessari per rilevare le scritture completate
+    from watchdog.observers.inotify import InotifyObserver
+except Exception:
+    InotifyObserver = None
+
 logger = logging.getLogger(__name__)
 
+# Tipi di evento processati quando 'events' non è configurato
+DEFAULT_EVENTS = ("created", "modified")
+
+
+class PatternMatcher:
+    """
+    Matcher dei pattern di inclusione/esclusione compilato una sola volta.
+
+    I pattern senza '/' vengono confrontati con il nome del file, quelli con '/'
+    con il percorso relativo alla directory monitorata e supportano '**' per
+    attraversare più livelli (es. 'incoming/**/*.csv'). Sono supportati anche
+    le alternative '{a,b}' e i pattern di esclusione con prefisso '!'.
+    I pattern del tipo '*.ext' sono risolti con un indice dei suffissi, tutti
+    gli altri confluiscono in un'unica espressione regolare.
+    """
+
+    def __init__(self, file_patterns=None, ignore_patterns=None, root="."):
+        self.root = os.path.normpath(root)
+        self._root_prefix = self.root.rstrip(os.sep) + os.sep
+        self._case_insensitive = os.name == "nt"
+
+        include, exclude = [], list(ignore_patterns or [])
+        for pattern in file_patterns if file_patterns is not None else ["*"]:
+            if pattern.startswith("!"):
+                exclude.append(pattern[1:])
+            else:
+                include.append(pattern)
+
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+
+    @staticmethod
+    def _expand_braces(pattern):
+        match = re.search(r"\{([^{}]*)\}", pattern)
+        if not match:
+            return [pattern]
+        expanded = []
+        for alternative in match.group(1).split(","):
+            expanded.extend(PatternMatcher._expand_braces(
+                pattern[:match.start()] + alternative + pattern[match.end():]
+            ))
+        return expanded
+
+    @staticmethod
+    def _translate(pattern):
+        """Traduce un glob in regex: '*' e '?' non attraversano '/', '**' sì"""
+        parts = []
+        i, n = 0, len(pattern)
+        while i < n:
+            char = pattern[i]
+            if char == "*":
+                if pattern.startswith("**", i):
+                    i += 2
+                    if i < n and pattern[i] == "/":
+                        parts.append("(?:.*/)?")
+                        i += 1
+                    else:
+                        parts.append(".*")
+                    continue
+                parts.append("[^/]*")
+            elif char == "?":
+                parts.append("[^/]")
+            elif char == "[":
+                end = pattern.find("]", i + 2)
+                if end == -1:
+                    parts.append(re.escape(char))
+                else:
+                    body = pattern[i + 1:end].replace("\\", "\\\\")
+                    if body.startswith("!"):
+                        body = "^" + body[1:]
+                    elif body.startswith("^"):
+                        body = "\\" + body
+                    parts.append(f"[{body}]")
+                    i = end + 1
+                    continue
+            else:
+                parts.append(re.escape(char))
+            i += 1
+        return "".join(parts)
+
+    def _compile(self, patterns):
+        """Restituisce (match_all, suffissi, regex sul nome, regex sul percorso)"""
+        match_all = False
+        suffixes, name_regexes, path_regexes = [], [], []
+        for raw in patterns:
+            for pattern in self._expand_braces(raw.replace(os.sep, "/")):
+                if self._case_insensitive:
+                    pattern = pattern.lower()
+                pattern = pattern.lstrip("/")
+                if pattern in ("*", "**", "**/*"):
+                    match_all = True
+                elif "/" in pattern:
+                    path_regexes.append(self._translate(pattern))
+                elif pattern.startswith("*") and not any(c in pattern[1:] for c in "*?[]"):
+                    suffixes.append(pattern[1:])
+                else:
+                    name_regexes.append(self._translate(pattern))
+
+        def combine(regexes):
+            return re.compile("(?:" + "|".join(regexes) + r")\Z", re.DOTALL) if regexes else None
+
+        return match_all, tuple(suffixes), combine(name_regexes), combine(path_regexes)
+
+    def _relative_path(self, file_path):
+        if file_path.startswith(self._root_prefix):
+            relative = file_path[len(self._root_prefix):]
+        else:
+            relative = os.path.relpath(file_path, self.root)
+        return relative.replace(os.sep, "/") if os.sep != "/" else relative
+
+    def _matches(self, compiled, file_name, file_path):
+        match_all, suffixes, name_regex, path_regex = compiled
+        if match_all:
+            return True
+        if suffixes and file_name.endswith(suffixes):
+            return True
+        if name_regex is not None and name_regex.match(file_name):
+            return True
+        if path_regex is not None:
+            relative = self._relative_path(file_path)
+            if self._case_insensitive:
+                relative = relative.lower()
+            return path_regex.match(relative) is not None
+        return False
+
+    def matches(self, file_path):
+        """Verifica se il file deve essere processato in base ai pattern"""
+        file_name = os.path.basename(file_path)
+        if self._case_insensitive:
+            file_name = file_name.lower()
+        if self._matches(self._exclude, file_name, file_path):
+            return False
+        return self._matches(self._include, file_name, file_path)
+
+
+class EventDebouncer:
+    """
+    Raggruppa gli eventi ravvicinati sullo stesso file in un unico evento logico.
+
+    Ogni evento apre (o prolunga) una finestra di assestamento per il percorso:
+    quando la finestra scade senza nuovi eventi, il callback viene invocato una
+    sola volta con il tipo di evento risultante. Il numero di percorsi in attesa
+    è limitato: oltre la soglia l'evento più vecchio viene consegnato subito.
+    """
+
+    def __init__(self, callback, window_ms, max_pending=10000):
+        self.callback = callback
+        self.window = window_ms / 1000.0
+        self.max_pending = max_pending
+        # percorso -> (tipo evento, scadenza); l'ordine di inserimento coincide
+        # con l'ordine delle scadenze perché ogni evento sposta la voce in coda
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="directory-debouncer", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _coalesce(previous, current):
+        """Calcola il tipo di evento risultante da due eventi consecutivi"""
+        if previous == 'created' and current == 'modified':
+            # Per il flusso il file è comunque nuovo
+            return 'created'
+        if previous == 'created' and current == 'deleted':
+            # File comparso e sparito nella stessa finestra: nessun evento
+            return None
+        if previous == 'deleted' and current in ('created', 'modified'):
+            # File sostituito
+            return 'modified'
+        return current
+
+    def submit(self, event_type, file_path):
+        """Registra un evento, posticipandone la consegna alla fine della finestra"""
+        overflow = None
+        with self._condition:
+            entry = self._pending.pop(file_path, None)
+            if entry is not None:
+                event_type = self._coalesce(entry[0], event_type)
+                if event_type is None:
+                    return
+            self._pending[file_path] = (event_type, time.monotonic() + self.window)
+            if len(self._pending) > self.max_pending:
+                overflow = self._pending.popitem(last=False)
+            self._condition.notify()
+
+        if overflow is not None:
+            overflow_path, (overflow_type, _) = overflow
+            logger.debug(f"Limite eventi in attesa raggiunto, consegna anticipata per: {overflow_path}")
+            self._deliver(overflow_type, overflow_path)
+
+    def _deliver(self, event_type, file_path):
+        try:
+            self.callback(event_type, file_path)
+        except Exception as e:
+            logger.error(f"Errore durante la consegna dell'evento {event_type} per {file_path}: {e}")
+
+    def _run(self):
+        while True:
+            due = []
+            with self._condition:
+                while self._running and not self._pending:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                now = time.monotonic()
+                for file_path, (event_type, deadline) in self._pending.items():
+                    if deadline > now:
+                        break
+                    due.append((event_type, file_path))
+                for _, file_path in due:
+                    del self._pending[file_path]
+                if not due:
+                    next_deadline = next(iter(self._pending.values()))[1]
+                    self._condition.wait(next_deadline - now)
+                    continue
+
+            for event_type, file_path in due:
+                self._deliver(event_type, file_path)
+
+    def stop(self):
+        """Ferma il thread e consegna subito gli eventi ancora in attesa"""
+        with self._condition:
+            self._running = False
+            pending = [(event_type, file_path) for file_path, (event_type, _) in self._pending.items()]
+            self._pending.clear()
+            self._condition.notify()
+        self._thread.join(timeout=5)
+        for event_type, file_path in pending:
+            self._deliver(event_type, file_path)
+
+
+class EventBatcher:
+    """
+    Accumula gli eventi per consegnarli in blocco: il batch viene chiuso quando
+    scade la finestra aperta dal primo evento oppure quando raggiunge max_size
+    file. Gli eventi successivi sullo stesso file vengono fusi in uno solo.
+    Il callback riceve la lista di (percorso, tipo evento).
+    """
+
+    def __init__(self, callback, window, max_size=1000):
+        self.callback = callback
+        self.window = float(window)
+        self.max_size = max(1, int(max_size))
+        self._events = OrderedDict()
+        self._deadline = None
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="directory-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, event_type, file_path):
+        batch = None
+        with self._condition:
+            previous = self._events.pop(file_path, None)
+            if previous is not None:
+                event_type = EventDebouncer._coalesce(previous, event_type)
+                if event_type is None:
+                    return
+            self._events[file_path] = event_type
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.window
+                self._condition.notify()
+            if len(self._events) >= self.max_size:
+                batch = self._take()
+        if batch:
+            self._deliver(batch)
+
+    def _take(self):
+        batch = list(self._events.items())
+        self._events.clear()
+        self._deadline = None
+        return batch
+
+    def _deliver(self, batch):
+        try:
+            self.callback(batch)
+        except Exception as e:
+            logger.error(f"Errore durante la consegna di un batch di {len(batch)} file: {e}")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and self._deadline is None:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                delay = self._deadline - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                batch = self._take()
+            if batch:
+                self._deliver(batch)
+
+    def stop(self):
+        """Ferma il thread e consegna subito il batch in corso"""
+        with self._condition:
+            self._running = False
+            batch = self._take()
+            self._condition.notify()
+        self._thread.join(timeout=5)
+        if batch:
+            self._deliver(batch)
+
+
+class WriteCompletionTracker:
+    """
+    Tiene traccia dei file ancora in scrittura e li segnala come completi
+    quando dimensione e mtime restano invariati per N controlli consecutivi.
+    """
+
+    def __init__(self, stable_checks=2):
+        self.stable_checks = max(1, int(stable_checks))
+        # percorso -> [tipo evento, (size, mtime_ns) dell'ultimo controllo, controlli stabili]
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def observe(self, event_type, file_path):
+        """Registra una scrittura in corso; un file creato resta 'created' fino al completamento"""
+        with self._lock:
+            state = self._pending.get(file_path)
+            if state is None:
+                self._pending[file_path] = [event_type, None, 0]
+
+    def discard(self, file_path):
+        """Smette di seguire un file, restituendo il tipo di evento in attesa (o None)"""
+        with self._lock:
+            state = self._pending.pop(file_path, None)
+        return state[0] if state else None
+
+    def check(self):
+        """Controlla i file in attesa e restituisce quelli la cui scrittura è completa"""
+        completed = []
+        with self._lock:
+            for file_path, state in list(self._pending.items()):
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    # File eliminato prima del completamento
+                    del self._pending[file_path]
+                    continue
+
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if signature == state[1]:
+                    state[2] += 1
+                    if state[2] >= self.stable_checks:
+                        completed.append((state[0], file_path))
+                        del self._pending[file_path]
+                else:
+                    state[1] = signature
+                    state[2] = 0
+        return completed
+
+
+# Impronta non calcolata: content_fingerprint non restituisce mai questo valore
+NO_HASH = -1
+
+
+def _hash64(data):
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def content_fingerprint(file_path):
+    """
+    Impronta a 64 bit del contenuto di un file, letto tramite mmap.
+    Usa xxhash se installato, altrimenti BLAKE2b a 64 bit (crittografico, più lento).
+    Il valore è con segno per poter essere salvato negli array e in SQLite.
+    """
+    with open(file_path, 'rb') as file:
+        # mmap non accetta file vuoti
+        if os.fstat(file.fileno()).st_size == 0:
+            value = _hash64(b'')
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                value = _hash64(data)
+    value = value - 2**64 if value >= 2**63 else value
+    return value if value != NO_HASH else NO_HASH - 1
+
+
+class FileSnapshot:
+    """
+    Snapshot compatto dei file osservati.
+
+    Invece di un dizionario per file, mantiene una tabella di percorsi e array
+    paralleli (mtime in nanosecondi, dimensione e impronta del contenuto)
+    indicizzati per slot; gli slot dei file eliminati vengono riutilizzati.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._paths = []
+        self._mtimes = array('q')
+        self._sizes = array('q')
+        self._hashes = array('q')
+        self._free = []
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, file_path):
+        return file_path in self._index
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def get(self, file_path):
+        """Restituisce (mtime_ns, size) del file o None se non presente"""
+        slot = self._index.get(file_path)
+        if slot is None:
+            return None
+        return self._mtimes[slot], self._sizes[slot]
+
+    def get_hash(self, file_path):
+        """Restituisce l'impronta del contenuto del file (NO_HASH se non calcolata)"""
+        slot = self._index.get(file_path)
+        return self._hashes[slot] if slot is not None else NO_HASH
+
+    def set(self, file_path, mtime_ns, size, content_hash=NO_HASH):
+        slot = self._index.get(file_path)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self._paths[slot] = file_path
+            else:
+                slot = len(self._paths)
+                self._paths.append(file_path)
+                self._mtimes.append(0)
+                self._sizes.append(0)
+                self._hashes.append(NO_HASH)
+            self._index[file_path] = slot
+        self._mtimes[slot] = mtime_ns
+        self._sizes[slot] = size
+        self._hashes[slot] = content_hash
+
+    def remove(self, file_path):
+        slot = self._index.pop(file_path, None)
+        if slot is not None:
+            self._paths[slot] = None
+            self._free.append(slot)
+
+
+class ContentChangeFilter:
+    """
+    Cache delle impronte del contenuto per gli eventi del watcher: scarta gli
+    eventi che non cambiano i dati del file. L'impronta viene ricalcolata solo
+    quando size o mtime risultano diversi da quelli in cache.
+    """
+
+    def __init__(self):
+        self.snapshot = FileSnapshot()
+        self._lock = threading.Lock()
+
+    def has_changed(self, file_path):
+        """Aggiorna la cache e indica se il contenuto del file è cambiato"""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            # File non più presente: l'evento viene comunque consegnato
+            return True
+
+        current = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            previous = self.snapshot.get(file_path)
+            previous_hash = self.snapshot.get_hash(file_path)
+        if previous == current:
+            return False
+
+        try:
+            fingerprint = content_fingerprint(file_path)
+        except (OSError, ValueError):
+            return True
+        with self._lock:
+            self.snapshot.set(file_path, *current, fingerprint)
+        return previous is None or fingerprint != previous_hash
+
+    def fingerprint(self, file_path):
+        with self._lock:
+            return self.snapshot.get_hash(file_path)
+
+    def forget(self, file_path):
+        with self._lock:
+            self.snapshot.remove(file_path)
+
+
+class IncrementalScanner:
+    """
+    Scansione dell'albero basata su os.scandir che riusa i dati di stat dei DirEntry.
+
+    Per ogni directory memorizza mtime e nomi dei figli. Con skip_unchanged_dirs
+    le directory il cui mtime non è cambiato non vengono rilette: creazioni ed
+    eliminazioni vengono comunque rilevate (modificano l'mtime della directory),
+    mentre le modifiche al contenuto dei file esistenti vengono rilevate solo
+    nelle scansioni complete eseguite ogni full_scan_every scansioni.
+
+    Con content_hash viene mantenuta anche un'impronta del contenuto, ricalcolata
+    solo quando size o mtime cambiano: se il contenuto è identico (touch, rsync,
+    riscritture senza modifiche) lo snapshot viene aggiornato senza generare eventi.
+    """
+
+    # Directory modificate più di recente di questa soglia vengono sempre rilette,
+    # perché un nuovo file potrebbe avere lo stesso mtime dell'ultima lettura
+    RACY_WINDOW_NS = 2 * 10**9
+
+    def __init__(self, root, should_process, snapshot=None, skip_unchanged_dirs=False,
+                 full_scan_every=10, recursive=True, content_hash=False):
+        self.root = os.path.normpath(root)
+        self.should_process = should_process
+        self.recursive = recursive
+        self.content_hash = content_hash
+        self.snapshot = snapshot if snapshot is not None else FileSnapshot()
+        self.skip_unchanged_dirs = skip_unchanged_dirs
+        self.full_scan_every = int(full_scan_every or 0)
+        # directory -> (mtime_ns o None, nomi file tracciati, nomi sottodirectory)
+        self._dirs = {}
+        self._scans = 0
+        # Directory non leggibili nell'ultima scansione (permessi, errori di I/O)
+        self._unreadable = set()
+
+    def scan(self, full_dirs=()):
+        """
+        Scansiona l'intero albero e restituisce la lista dei cambiamenti (tipo, percorso).
+
+        Le directory in full_dirs vengono sempre rilette per intero, anche quando
+        il loro mtime non è cambiato.
+        """
+        self._scans += 1
+        full = (not self.skip_unchanged_dirs
+                or (self.full_scan_every > 0 and self._scans % self.full_scan_every == 0))
+        changes = []
+        self._unreadable = set()
+        stack = [self.root]
+        while stack:
+            dir_path = stack.pop()
+            subdirs = self.scan_dir(dir_path, changes, full or dir_path in full_dirs)
+            if self.recursive:
+                stack.extend(os.path.join(dir_path, name) for name in subdirs)
+
+        if self._scans == 1 and len(self.snapshot):
+            # Snapshot caricato da una sessione precedente: le directory non sono
+            # ancora in cache, quindi le eliminazioni vanno cercate esplicitamente
+            self._sweep_unseen(changes)
+        return changes
+
+    def _sweep_unseen(self, changes):
+        """Segnala come eliminati i file dello snapshot non trovati nella prima scansione"""
+        names = {}
+        for file_path in list(self.snapshot):
+            dir_path, name = os.path.split(file_path)
+            if self._is_unreadable(dir_path):
+                # Directory non letta: i suoi file non sono necessariamente spariti
+                continue
+            if dir_path not in names:
+                cached = self._dirs.get(dir_path)
+                names[dir_path] = frozenset(cached[1]) if cached else frozenset()
+            if name in names[dir_path]:
+                continue
+            if os.path.lexists(file_path):
+                # Il file esiste ma non corrisponde più ai pattern: lo si dimentica in silenzio
+                self.snapshot.remove(file_path)
+            else:
+                self._remove_file(file_path, changes)
+
+    def _is_unreadable(self, dir_path):
+        return any(dir_path == path or dir_path.startswith(path + os.sep) for path in self._unreadable)
+
+    def scan_dir(self, dir_path, changes, full=True):
+        """
+        Scansiona una singola directory (senza ricorsione), aggiungendo i
+        cambiamenti a changes. Restituisce i nomi delle sottodirectory.
+        """
+        cached = self._dirs.get(dir_path)
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            self.remove_dir(dir_path, changes)
+            return ()
+
+        if cached is not None and not full and cached[0] == dir_mtime:
+            return cached[2]
+
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            # Come os.walk: i link a directory non vengono seguiti
+                            if not entry.is_symlink():
+                                subdirs.append(sys.intern(entry.name))
+                            continue
+                        if not self.should_process(entry.path):
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        # File potrebbe essere stato eliminato durante la scansione
+                        continue
+
+                    files.append(sys.intern(entry.name))
+                    previous = self.snapshot.get(entry.path)
+                    current = (stat.st_mtime_ns, stat.st_size)
+                    if previous == current:
+                        continue
+
+                    fingerprint = NO_HASH
+                    if self.content_hash:
+                        try:
+                            fingerprint = content_fingerprint(entry.path)
+                        except (OSError, ValueError):
+                            continue
+                        if previous is not None and fingerprint == self.snapshot.get_hash(entry.path):
+                            # Cambiato solo l'mtime: il contenuto è identico
+                            self.snapshot.set(entry.path, *current, fingerprint)
+                            continue
+
+                    changes.append(('created' if previous is None else 'modified', entry.path))
+                    self.snapshot.set(entry.path, *current, fingerprint)
+        except FileNotFoundError:
+            self.remove_dir(dir_path, changes)
+            return ()
+        except OSError as e:
+            # Come os.walk: la directory viene saltata e la scansione prosegue. Lo stato
+            # in cache resta invariato, così i suoi file non risultano eliminati
+            logger.warning(f"Impossibile leggere la directory {dir_path}: {e}")
+            self._unreadable.add(dir_path)
+            return cached[2] if cached is not None else ()
+
+        if cached is not None:
+            current_files = set(files)
+            for name in cached[1]:
+                if name not in current_files:
+                    self._remove_file(os.path.join(dir_path, name), changes)
+            current_subdirs = set(subdirs)
+            for name in cached[2]:
+                if name not in current_subdirs:
+                    self.remove_dir(os.path.join(dir_path, name), changes)
+
+        if time.time_ns() - dir_mtime < self.RACY_WINDOW_NS:
+            dir_mtime = None
+        self._dirs[dir_path] = (dir_mtime, tuple(files), tuple(subdirs))
+        return subdirs
+
+    def _remove_file(self, file_path, changes):
+        if file_path in self.snapshot:
+            self.snapshot.remove(file_path)
+            changes.append(('deleted', file_path))
+
+    def remove_dir(self, dir_path, changes):
+        """Dimentica una directory eliminata e tutto il suo sottoalbero"""
+        stack = [dir_path]
+        while stack:
+            current = stack.pop()
+            cached = self._dirs.pop(current, None)
+            if cached is None:
+                continue
+            for name in cached[1]:
+                self._remove_file(os.path.join(current, name), changes)
+            stack.extend(os.path.join(current, name) for name in cached[2])
+
+
+class SnapshotStore:
+    """
+    Persistenza su SQLite dello snapshot dei file, così che dopo un riavvio il
+    listener possa rilevare i cambiamenti avvenuti mentre era fermo.
+    Un unico database può ospitare gli snapshot di più directory monitorate.
+    """
+
+    def __init__(self, db_path, watch_path):
+        self.watch_path = os.path.abspath(watch_path)
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                "watch_path TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "watch_path TEXT NOT NULL, path TEXT NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, "
+                f"content_hash INTEGER NOT NULL DEFAULT {NO_HASH}, "
+                "PRIMARY KEY (watch_path, path))"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(files)")]
+            if "content_hash" not in columns:
+                # Database creato da una versione precedente del plugin
+                self._conn.execute(f"ALTER TABLE files ADD COLUMN content_hash INTEGER NOT NULL DEFAULT {NO_HASH}")
+
+    def load(self):
+        """Restituisce lo snapshot salvato o None se la directory non è mai stata scansionata"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM snapshots WHERE watch_path = ?", (self.watch_path,)
+            ).fetchone()
+            if row is None:
+                return None
+            snapshot = FileSnapshot()
+            cursor = self._conn.execute(
+                "SELECT path, mtime_ns, size, content_hash FROM files WHERE watch_path = ?",
+                (self.watch_path,)
+            )
+            for file_path, mtime_ns, size, content_hash in cursor:
+                snapshot.set(file_path, mtime_ns, size, content_hash)
+        return snapshot
+
+    def save(self, snapshot):
+        """Sostituisce lo snapshot salvato con quello fornito"""
+        rows = []
+        for file_path in snapshot:
+            mtime_ns, size = snapshot.get(file_path)
+            rows.append((self.watch_path, file_path, mtime_ns, size, snapshot.get_hash(file_path)))
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM files WHERE watch_path = ?", (self.watch_path,))
+            self._conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", rows)
+            self._touch()
+
+    def save_changes(self, snapshot, changes):
+        """Aggiorna solo le righe dei file cambiati"""
+        if not changes:
+            return
+        upserts = []
+        deletes = []
+        for event_type, file_path in changes:
+            info = snapshot.get(file_path)
+            if event_type == 'deleted' or info is None:
+                deletes.append((self.watch_path, file_path))
+            else:
+                upserts.append((self.watch_path, file_path) + tuple(info) + (snapshot.get_hash(file_path),))
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM files WHERE watch_path = ? AND path = ?", deletes)
+            self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", upserts)
+            self._touch()
+
+    def record(self, file_path, content_hash=NO_HASH, info=None):
+        """
+        Aggiorna la riga di un singolo file con info (mtime_ns, size) o, se non
+        fornito, leggendone lo stato attuale dal disco
+        """
+        if info is None:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                self.forget(file_path)
+                return
+            info = (stat.st_mtime_ns, stat.st_size)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (self.watch_path, file_path) + tuple(info) + (content_hash,)
+            )
+
+    def forget(self, file_path):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM files WHERE watch_path = ? AND path = ?", (self.watch_path, file_path)
+            )
+
+    def _touch(self):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?)", (self.watch_path, time.time())
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def run_catch_up(changes, process, rate=10.0):
+    """
+    Invia gli eventi di recupero al ritmo massimo di 'rate' eventi al secondo
+    (0 = nessun limite) per non saturare il motore dei flussi; l'esecuzione
+    in parallelo è affidata al dispatcher dei flussi.
+    """
+    if not changes:
+        return
+    logger.info(f"Recupero di {len(changes)} cambiamenti avvenuti durante l'inattività")
+    interval = 1.0 / rate if rate and rate > 0 else 0
+    next_start = time.monotonic()
+    for done, (event_type, file_path) in enumerate(changes, 1):
+        if interval:
+            delay = next_start - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_start = max(next_start, time.monotonic() - interval) + interval
+        process(event_type, file_path)
+        if done % 1000 == 0:
+            logger.info(f"Recupero in corso: {done}/{len(changes)}")
+    logger.info("Recupero completato")
+
+
+def event_variables(event_type, file_path):
+    """Variabili dell'evento iniettate nel flusso"""
+    return {
+        'event_type': event_type,
+        'file_path': file_path,
+        'file_name': os.path.basename(file_path),
+        'file_dir': os.path.dirname(file_path),
+        'timestamp': time.time()
+    }
+
+
+def batch_variables(batch):
+    """
+    Variabili iniettate nel flusso in modalità batch: 'files' contiene per ogni
+    file percorso, nome, tipo di evento, dimensione e mtime (None se eliminato).
+    """
+    files = []
+    for file_path, event_type in batch:
+        entry = {
+            'path': file_path,
+            'name': os.path.basename(file_path),
+            'event_type': event_type,
+            'size': None,
+            'mtime': None
+        }
+        if event_type != 'deleted':
+            try:
+                stat = os.stat(file_path)
+                entry['size'] = stat.st_size
+                entry['mtime'] = stat.st_mtime
+            except OSError:
+                pass
+        files.append(entry)
+    return {
+        'event_type': 'batch',
+        'files': files,
+        'file_count': len(files),
+        'timestamp': time.time()
+    }
+
+
+def execute_flow(config_file, global_context, variables):
+    """
+    Carica la configurazione ed esegue il flusso con le variabili fornite.
+    Funzione di modulo così da poter essere eseguita anche in un processo separato.
+    """
+    with open(config_file, 'r') as file:
+        config = safe_load(file)
+
+    flow = FlowDiagram(config, global_context)
+    flow.variables.update(variables)
+    flow.run()
+
+
+class FlowDispatcher:
+    """
+    Esegue i flussi su un pool di worker limitato mantenendo l'ordine per file.
+
+    Ogni percorso viene assegnato sempre alla stessa coda (hash del percorso),
+    servita da un unico thread: gli eventi dello stesso file restano in ordine,
+    file diversi vengono processati in parallelo. In modalità 'process' i thread
+    delegano l'esecuzione a un pool di processi, utile per flussi CPU-bound
+    (global_context deve essere serializzabile con pickle).
+    Le code sono limitate: quando sono piene, submit blocca il chiamante.
+    """
+
+    def __init__(self, config_file, global_context, workers=1, mode="thread", max_queue_size=1000):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"worker_mode non valido: {mode} (valori ammessi: thread, process)")
+        self.config_file = config_file
+        self.global_context = global_context
+        workers = max(1, int(workers))
+        per_queue = max(1, int(max_queue_size) // workers)
+        self._queues = [queue.Queue(maxsize=per_queue) for _ in range(workers)]
+        self._pool = ProcessPoolExecutor(max_workers=workers) if mode == "process" else None
+        self._lock = threading.Lock()
+        # Eventi ancora da completare per gruppo, per attendere solo i propri (vedi join)
+        self._groups = {}
+        self._group_done = threading.Condition(self._lock)
+        self._metrics = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'skipped': 0,
+            'in_flight': 0,
+            'last_lag': 0.0,
+            'max_lag': 0.0,
+            'total_lag': 0.0
+        }
+        self._threads = []
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._worker, args=(work_queue,), name=f"directory-worker-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, file_path, variables, on_done=None, should_run=None, group=None):
+        """
+        Accoda l'esecuzione del flusso; on_done viene chiamato al termine, se il flusso
+        non è fallito (un evento fallito non deve risultare processato). should_run, se fornito, viene valutato dal worker prima del flusso
+        (nell'ordine degli eventi del file) e può annullarne l'esecuzione.
+        group permette di attendere con join solo gli eventi di quel gruppo.
+        """
+        shard = zlib.crc32(file_path.encode('utf-8', 'surrogateescape')) % len(self._queues)
+        with self._lock:
+            self._metrics['submitted'] += 1
+            if group is not None:
+                self._groups[group] = self._groups.get(group, 0) + 1
+        self._queues[shard].put((time.monotonic(), file_path, variables, on_done, should_run, group))
+
+    def _worker(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                work_queue.task_done()
+                return
+
+            enqueued_at, file_path, variables, on_done, should_run, group = item
+            lag = time.monotonic() - enqueued_at
+            with self._lock:
+                self._metrics['in_flight'] += 1
+                self._metrics['last_lag'] = lag
+                self._metrics['max_lag'] = max(self._metrics['max_lag'], lag)
+                self._metrics['total_lag'] += lag
+
+            outcome = 'completed'
+            try:
+                if should_run and not should_run():
+                    outcome = 'skipped'
+                elif self._pool:
+                    self._pool.submit(execute_flow, self.config_file, self.global_context, variables).result()
+                else:
+                    execute_flow(self.config_file, self.global_context, variables)
+            except Exception as e:
+                outcome = 'failed'
+                logger.error(f"Errore durante l'elaborazione dell'evento {variables.get('event_type')} per {file_path}: {e}")
+            finally:
+                with self._lock:
+                    self._metrics['in_flight'] -= 1
+                    self._metrics[outcome] += 1
+                if on_done and outcome != 'failed':
+                    try:
+                        on_done()
+                    except Exception as e:
+                        logger.error(f"Errore nel completamento dell'evento per {file_path}: {e}")
+                if group is not None:
+                    with self._lock:
+                        self._groups[group] -= 1
+                        self._group_done.notify_all()
+                work_queue.task_done()
+
+    def metrics(self):
+        """Profondità delle code, elementi in esecuzione e ritardo di elaborazione (secondi)"""
+        with self._lock:
+            metrics = dict(self._metrics)
+        started = metrics['completed'] + metrics['failed'] + metrics['skipped'] + metrics['in_flight']
+        metrics['avg_lag'] = metrics.pop('total_lag') / started if started else 0.0
+        metrics['queue_depth'] = sum(work_queue.qsize() for work_queue in self._queues)
+        return metrics
+
+    def log_metrics(self):
+        m = self.metrics()
+        logger.info(
+            f"Worker flussi: in coda {m['queue_depth']}, in esecuzione {m['in_flight']}, "
+            f"completati {m['completed']}, falliti {m['failed']}, scartati {m['skipped']}, "
+            f"ritardo ultimo/medio/max {m['last_lag']:.2f}/{m['avg_lag']:.2f}/{m['max_lag']:.2f}s"
+        )
+
+    def join(self, group=None):
+        """Attende che gli eventi accodati (di un gruppo, o tutti) siano stati processati"""
+        if group is not None:
+            with self._group_done:
+                while self._groups.get(group, 0) > 0:
+                    self._group_done.wait()
+            return
+        for work_queue in self._queues:
+            work_queue.join()
+
+    def stop(self):
+        """Processa gli eventi ancora in coda e ferma i worker"""
+        for work_queue in self._queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._pool:
+            self._pool.shutdown()
+
+
+def iter_files(root, should_process, recursive=True):
+    """Enumera con os.scandir i file esistenti che corrispondono ai pattern"""
+    stack = [os.path.normpath(root)]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if recursive and not entry.is_symlink():
+                                stack.append(entry.path)
+                        elif should_process(entry.path):
+                            yield entry.path
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f"Impossibile leggere la directory {dir_path}: {e}")
+
+
+class BackfillCheckpoint:
+    """Checkpoint SQLite del backfill: file già processati e completamento"""
+
+    FLUSH_EVERY = 500
+
+    def __init__(self, db_path, watch_path):
+        self.watch_path = os.path.abspath(watch_path)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS backfill_done ("
+                "watch_path TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY (watch_path, path))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS backfill_status ("
+                "watch_path TEXT PRIMARY KEY, completed_at REAL NOT NULL)"
+            )
+
+    def is_complete(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM backfill_status WHERE watch_path = ?", (self.watch_path,)
+            ).fetchone()
+        return row is not None
+
+    def is_done(self, file_path):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM backfill_done WHERE watch_path = ? AND path = ?",
+                (self.watch_path, file_path)
+            ).fetchone()
+        return row is not None
+
+    def mark_done(self, file_path):
+        with self._lock:
+            self._buffer.append((self.watch_path, file_path))
+            if len(self._buffer) >= self.FLUSH_EVERY:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if self._buffer:
+            with self._conn:
+                self._conn.executemany("INSERT OR IGNORE INTO backfill_done VALUES (?, ?)", self._buffer)
+            self._buffer = []
+
+    def mark_complete(self):
+        """Registra il completamento; l'elenco dei file processati non serve più"""
+        with self._lock, self._conn:
+            self._buffer = []
+            self._conn.execute("INSERT OR REPLACE INTO backfill_status VALUES (?, ?)", (self.watch_path, time.time()))
+            self._conn.execute("DELETE FROM backfill_done WHERE watch_path = ?", (self.watch_path,))
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self._conn.close()
+
+
+class Backfill:
+    """
+    Elabora i file già presenti nella directory all'avvio, in un thread separato
+    e in parallelo al monitoraggio degli eventi.
+
+    I file vengono distribuiti sulle code del dispatcher (per hash del percorso),
+    quindi sullo stesso worker degli eventi live di quel file. Un file già
+    gestito da un evento live prima del suo turno viene saltato. Con un
+    checkpoint i file processati vengono registrati e, dopo un riavvio, il
+    backfill riprende da dove si era fermato; a backfill completato non viene
+    più eseguito.
+    """
+
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, root, should_process, dispatcher, checkpoint=None, recursive=True):
+        self.root = root
+        self.should_process = should_process
+        self.dispatcher = dispatcher
+        self.checkpoint = checkpoint
+        self.recursive = recursive
+        # Percorsi già consegnati dagli eventi live durante il backfill
+        self.live_paths = set()
+        self.active = False
+        self._running = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._progress = {'found': 0, 'queued': 0, 'processed': 0, 'skipped': 0}
+
+    def mark_live(self, file_path):
+        """Segnala che un file è stato consegnato da un evento live"""
+        if self.active:
+            self.live_paths.add(file_path)
+
+    def progress(self):
+        with self._lock:
+            return dict(self._progress, active=self.active)
+
+    def _count(self, key):
+        with self._lock:
+            self._progress[key] += 1
+
+    def start(self):
+        if self.checkpoint and self.checkpoint.is_complete():
+            logger.info("Backfill già completato in precedenza, nessun file da recuperare")
+            return
+        self.active = True
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="directory-backfill", daemon=True)
+        self._thread.start()
+
+    def _should_run(self, file_path):
+        if file_path in self.live_paths:
+            self._count('skipped')
+            return False
+        return True
+
+    def _done(self, file_path):
+        self._count('processed')
+        if self.checkpoint:
+            self.checkpoint.mark_done(file_path)
+
+    def _run(self):
+        logger.info(f"Backfill dei file esistenti avviato: {self.root}")
+        last_progress = time.monotonic()
+        completed = True
+        for file_path in iter_files(self.root, self.should_process, self.recursive):
+            if not self._running:
+                completed = False
+                break
+            self._count('found')
+            if self.checkpoint and self.checkpoint.is_done(file_path):
+                self._count('skipped')
+                continue
+
+            variables = event_variables('created', file_path)
+            variables['backfill'] = True
+            self.dispatcher.submit(
+                file_path,
+                variables,
+                on_done=lambda path=file_path: self._done(path),
+                should_run=lambda path=file_path: self._should_run(path),
+                group=self
+            )
+            self._count('queued')
+
+            if time.monotonic() - last_progress >= self.PROGRESS_INTERVAL:
+                self.log_progress()
+                last_progress = time.monotonic()
+
+        self.dispatcher.join(group=self)
+        if completed and self.checkpoint:
+            self.checkpoint.mark_complete()
+        self.active = False
+        self.live_paths = set()
+        self.log_progress()
+        logger.info("Backfill completato" if completed else "Backfill interrotto, riprenderà al prossimo avvio")
+
+    def log_progress(self):
+        p = self.progress()
+        logger.info(
+            f"Backfill: trovati {p['found']}, accodati {p['queued']}, "
+            f"processati {p['processed']}, saltati {p['skipped']}"
+        )
+
+    def stop(self):
+        """Interrompe l'enumerazione e attende i file già accodati"""
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        if self.checkpoint:
+            self.checkpoint.close()
+
+
+def create_backfill(event_config, watch_path, should_process, dispatcher, recursive=True):
+    """Crea il backfill se 'backfill' è abilitato; il checkpoint usa 'backfill_checkpoint' o 'state_db'"""
+    if not event_config.get("backfill", False):
+        return None
+    checkpoint_path = event_config.get("backfill_checkpoint") or event_config.get("state_db")
+    checkpoint = BackfillCheckpoint(checkpoint_path, watch_path) if checkpoint_path else None
+    return Backfill(watch_path, should_process, dispatcher, checkpoint, recursive)
+
+
+def create_dispatcher(event_config, config_file, global_context):
+    """Crea il dispatcher dei flussi in base alla configurazione del listener"""
+    return FlowDispatcher(
+        config_file,
+        global_context,
+        workers=event_config.get("workers", 1),
+        mode=event_config.get("worker_mode", "thread"),
+        max_queue_size=event_config.get("max_queue_size", 1000)
+    )
+
+
+def open_snapshot_store(event_config, watch_path):
+    """Apre lo store persistente se 'state_db' è configurato"""
+    db_path = event_config.get("state_db")
+    return SnapshotStore(db_path, watch_path) if db_path else None
+
+
 class DirectoryEventHandler(FileSystemEventHandler):
     """Handler per gli eventi del file system"""
     
-    def __init__(self, config_file, global_context, event_config):
+    def __init__(self, config_file, global_context, event_config, close_events=False, snapshot_store=None):
         self.config_file = config_file
+        self.snapshot_store = snapshot_store
         self.global_context = global_context
         self.event_config = event_config
+        self.dispatcher = create_dispatcher(event_config, config_file, global_context)
         self.file_patterns = event_config.get("file_patterns", ["*"])
         self.ignore_patterns = event_config.get("ignore_patterns", [])
+        self.matcher = PatternMatcher(
+            self.file_patterns, self.ignore_patterns, event_config.get("watch_path", ".")
+        )
+        self.events = frozenset(event_config.get("events", DEFAULT_EVENTS))
+        self.fingerprints = ContentChangeFilter() if event_config.get("content_hash", False) else None
+        self.backfill = None
+
+        # Modalità batch: un'unica esecuzione del flusso per più file
+        self.batcher = None
+        if event_config.get("batch_mode", False):
+            self.batcher = EventBatcher(
+                self.run_batch,
+                event_config.get("batch_window", 5),
+                event_config.get("batch_size", 1000)
+            )
+
+        # Finestra di assestamento per raggruppare eventi ravvicinati (0 = disabilitata)
+        debounce_ms = float(event_config.get("debounce_ms", 0))
+        self.debouncer = None
+        if debounce_ms > 0:
+            self.debouncer = EventDebouncer(
+                self.deliver,
+                debounce_ms,
+                int(event_config.get("max_pending_events", 10000))
+            )
+
+        # Attesa del completamento della scrittura: con inotify si usano gli eventi
+        # di chiusura, altrimenti si attende che size/mtime restino stabili
+        self.wait_for_write_complete = bool(event_config.get("wait_for_write_complete", False))
+        self.close_events = close_events
+        # percorso -> [tipo evento, scadenza]: senza IN_CLOSE_WRITE entro write_timeout
+        # dall'ultimo evento (file spostati nell'albero, link) la scrittura è considerata completa
+        self._writing = {}
+        self._writing_lock = threading.Lock()
+        self.write_timeout = float(event_config.get("write_timeout", 10))
+        self.write_tracker = None
+        if self.wait_for_write_complete and not close_events:
+            self.write_tracker = WriteCompletionTracker(event_config.get("stable_checks", 2))
         
     def should_process_file(self, file_path):
         """Verifica se il file deve essere processato in base ai pattern"""
-        file_name = os.path.basename(file_path)
-        
-        # Verifica pattern di esclusione
-        for ignore_pattern in self.ignore_patterns:
-            if self._match_pattern(file_name, ignore_pattern):
-                return False
-                
-        # Verifica pattern di inclusione
-        for pattern in self.file_patterns:
-            if self._match_pattern(file_name, pattern):
-                return True
-                
-        return False
-    
-    def _match_pattern(self, filename, pattern):
-        """Semplice matching di pattern con wildcard"""
-        import fnmatch
-        return fnmatch.fnmatch(filename, pattern)
+        return self.matcher.matches(file_path)
     
     def process_event(self, event_type, file_path):
         """Processa un evento del file system"""
+        if event_type not in self.events:
+            if event_type == 'deleted' and self.snapshot_store:
+                self.snapshot_store.forget(file_path)
+            return
         if not self.should_process_file(file_path):
             return
-            
+        if self.backfill:
+            self.backfill.mark_live(file_path)
+
+        if self.debouncer:
+            self.debouncer.submit(event_type, file_path)
+        else:
+            self.deliver(event_type, file_path)
+
+    def deliver(self, event_type, file_path):
+        """Consegna un evento filtrato al batch in corso o direttamente al flusso"""
+        if self.batcher:
+            self.batcher.submit(event_type, file_path)
+        else:
+            self.run_flow(event_type, file_path)
+
+    def run_batch(self, batch):
+        """Accoda un'unica esecuzione del flusso per un batch di (percorso, tipo evento)"""
+        if self.fingerprints:
+            batch = [(file_path, event_type) for file_path, event_type in batch
+                     if self._content_changed(event_type, file_path)]
+        if not batch:
+            return
+        logger.info(f"Batch di {len(batch)} eventi pronto per l'elaborazione")
+
+        on_done = None
+        if self.snapshot_store:
+            def on_done():
+                for file_path, event_type in batch:
+                    if event_type == 'deleted':
+                        self.snapshot_store.forget(file_path)
+                    else:
+                        self.snapshot_store.record(
+                            file_path, self.fingerprints.fingerprint(file_path) if self.fingerprints else NO_HASH
+                        )
+
+        # Chiave unica: i batch vengono processati in ordine uno dopo l'altro
+        self.dispatcher.submit(self.matcher.root, batch_variables(batch), on_done)
+
+    def run_flow(self, event_type, file_path):
+        """Accoda l'esecuzione del flusso configurato per un evento"""
         logger.info(f"Evento {event_type} rilevato per: {file_path}")
-        
-        try:
-            # Carica la configurazione del flusso
-            with open(self.config_file, 'r') as file:
-                config = safe_load(file)
-            
-            # Crea il flusso con le variabili dell'evento
-            flow = FlowDiagram(config, self.global_context)
-            flow.variables.update({
-                'event_type': event_type,
-                'file_path': file_path,
-                'file_name': os.path.basename(file_path),
-                'file_dir': os.path.dirname(file_path),
-                'timestamp': time.time()
-            })
-            
-            # Esegui il flusso
-            flow.run()
-            
-        except Exception as e:
-            logger.error(f"Errore durante l'elaborazione dell'evento {event_type} per {file_path}: {e}")
+
+        on_done = None
+        if self.snapshot_store:
+            # Registra lo stato processato per il recupero dopo un riavvio
+            if event_type == 'deleted':
+                on_done = lambda: self.snapshot_store.forget(file_path)
+            else:
+                on_done = lambda: self.snapshot_store.record(
+                    file_path, self.fingerprints.fingerprint(file_path) if self.fingerprints else NO_HASH
+                )
+
+        should_run = None
+        if self.fingerprints:
+            should_run = lambda: self._content_changed(event_type, file_path)
+
+        self.dispatcher.submit(file_path, event_variables(event_type, file_path), on_done, should_run)
+
+    def process_catch_up(self, event_type, file_path):
+        """
+        Consegna un cambiamento avvenuto mentre il listener era fermo: come per gli eventi
+        live, con wait_for_write_complete il flusso parte solo a scrittura completata
+        """
+        if self.wait_for_write_complete and event_type in ('created', 'modified'):
+            self.process_write_event(event_type, file_path)
+        else:
+            self.deliver(event_type, file_path)
+
+    def _content_changed(self, event_type, file_path):
+        """Eseguito dal worker: scarta gli eventi che non cambiano il contenuto del file"""
+        if event_type == 'deleted':
+            self.fingerprints.forget(file_path)
+            return True
+        if self.fingerprints.has_changed(file_path):
+            return True
+        logger.debug(f"Contenuto invariato, evento {event_type} ignorato per: {file_path}")
+        return False
     
+    def process_write_event(self, event_type, file_path):
+        """Gestisce created/modified, rimandandoli al completamento della scrittura se richiesto"""
+        if not self.events.intersection(('created', 'modified')):
+            return
+        if not self.wait_for_write_complete:
+            self.process_event(event_type, file_path)
+        elif not self.should_process_file(file_path):
+            return
+        elif self.close_events:
+            deadline = time.monotonic() + self.write_timeout
+            with self._writing_lock:
+                pending = self._writing.get(file_path)
+                if pending is None:
+                    self._writing[file_path] = [event_type, deadline]
+                else:
+                    # Scrittura ancora attiva: un file creato resta 'created'
+                    pending[1] = deadline
+        else:
+            self.write_tracker.observe(event_type, file_path)
+
+    def check_pending_writes(self):
+        """
+        Processa i file la cui scrittura risulta completa: senza eventi di chiusura quelli
+        stabili, con inotify quelli senza IN_CLOSE_WRITE né attività entro write_timeout
+        """
+        if self.write_tracker:
+            for event_type, file_path in self.write_tracker.check():
+                self.process_event(event_type, file_path)
+        if self.close_events and self._writing:
+            now = time.monotonic()
+            expired = []
+            with self._writing_lock:
+                for file_path, (event_type, deadline) in list(self._writing.items()):
+                    if now >= deadline:
+                        del self._writing[file_path]
+                        expired.append((event_type, file_path))
+            for event_type, file_path in expired:
+                if os.path.exists(file_path):
+                    logger.debug(f"Nessun evento di chiusura per {file_path}: scrittura considerata completa")
+                    self.process_event(event_type, file_path)
+
+    def _forget_write(self, file_path):
+        """Smette di attendere un file, restituendo il tipo di evento in attesa (o None)"""
+        if self.write_tracker:
+            return self.write_tracker.discard(file_path)
+        with self._writing_lock:
+            pending = self._writing.pop(file_path, None)
+        return pending[0] if pending else None
+
     def on_created(self, event):
         if not event.is_directory:
-            self.process_event('created', event.src_path)
+            self.process_write_event('created', event.src_path)
     
     def on_modified(self, event):
         if not event.is_directory:
-            self.process_event('modified', event.src_path)
+            self.process_write_event('modified', event.src_path)
+
+    def on_closed(self, event):
+        if not event.is_directory and self.close_events:
+            # IN_CLOSE_WRITE: la scrittura è terminata
+            event_type = self._forget_write(event.src_path)
+            if event_type:
+                self.process_event(event_type, event.src_path)
     
     def on_deleted(self, event):
         if not event.is_directory:
+            if self.wait_for_write_complete and self._forget_write(event.src_path) == 'created':
+                # Il flusso non ha mai visto il file: nessun evento da segnalare
+                return
             self.process_event('deleted', event.src_path)
     
     def on_moved(self, event):
         if not event.is_directory:
-            self.process_event('moved', event.dest_path)
+            pending = None
+            if self.wait_for_write_complete:
+                pending = self._forget_write(event.src_path)
+                # La rinomina sostituisce la destinazione: niente più attese su di essa
+                self._forget_write(event.dest_path)
+            if self.snapshot_store:
+                self.snapshot_store.forget(event.src_path)
+            if pending == 'created' or not self.should_process_file(event.src_path):
+                # Upload atomico (file temporaneo rinominato) o file mai segnalato al flusso:
+                # la rinomina è atomica, il file di destinazione è nuovo e già completo
+                self.process_event('created', event.dest_path)
+            else:
+                self.process_event('moved', event.dest_path)
+
+    def stop(self):
+        """Consegna e processa gli eventi ancora in attesa prima della chiusura"""
+        if self.debouncer:
+            self.debouncer.stop()
+        if self.batcher:
+            self.batcher.stop()
+        self.dispatcher.stop()
+
+
+class HybridEventHandler(DirectoryEventHandler):
+    """Handler del backend ibrido: segnala l'attività al watcher prima di processare l'evento"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.watcher = None
+
+    def dispatch(self, event):
+        if self.watcher:
+            self.watcher.record_activity(event)
+        super().dispatch(event)
+
+
+class HybridWatcher:
+    """
+    Backend ibrido per alberi molto grandi.
+
+    Le directory "calde" (con attività recente) ricevono un watch nativo non
+    ricorsivo, quelle "fredde" vengono controllate dallo scanner incrementale a
+    bassa frequenza. Una directory in cui il polling rileva cambiamenti viene
+    promossa a calda; una directory calda senza eventi per hot_ttl secondi torna
+    fredda. Il numero di watch nativi è limitato da max_hot_dirs (le meno
+    recenti vengono retrocesse), indipendentemente dalla dimensione dell'albero.
+    """
+
+    def __init__(self, observer, handler, scanner, max_hot_dirs=1000, hot_ttl=300):
+        self.observer = observer
+        self.handler = handler
+        self.scanner = scanner
+        self.max_hot_dirs = max(1, int(max_hot_dirs))
+        self.hot_ttl = float(hot_ttl)
+        # directory -> [watch, ultima attività], in ordine di attività (LRU)
+        self._hot = OrderedDict()
+        self._pinned = set()
+        # Directory da promuovere, raccolte dal thread dell'observer
+        self._to_promote = set()
+        # File già consegnati dagli eventi nativi dall'ultimo controllo a polling
+        self._seen = set()
+        self._lock = threading.Lock()
+        handler.watcher = self
+
+    @property
+    def hot_dirs(self):
+        with self._lock:
+            return list(self._hot)
+
+    # schedule/unschedule prendono il lock dell'observer, che il suo thread tiene mentre
+    # consegna gli eventi a record_activity: vanno chiamati senza tenere self._lock.
+    # Promozioni e retrocessioni avvengono solo nel thread principale del listener.
+
+    def promote(self, dir_path, pinned=False, rescan=True):
+        """
+        Registra un watch nativo sulla directory, retrocedendo la meno recente se necessario.
+
+        Con rescan, dopo la registrazione del watch la directory viene riletta e confrontata
+        con lo snapshot: i file scritti prima che il watch fosse attivo (ad esempio in una
+        directory appena creata) vengono consegnati.
+        """
+        evicted = None
+        with self._lock:
+            if pinned:
+                self._pinned.add(dir_path)
+            if dir_path in self._hot:
+                self._hot[dir_path][1] = time.monotonic()
+                self._hot.move_to_end(dir_path)
+                return
+            if len(self._hot) >= self.max_hot_dirs:
+                evicted = next((candidate for candidate in self._hot if candidate not in self._pinned), None)
+        if evicted is not None:
+            self._demote(evicted)
+        try:
+            watch = self.observer.schedule(self.handler, dir_path, recursive=False)
+        except OSError as e:
+            # Es. fs.inotify.max_user_watches esaurito: la directory resta fredda
+            logger.warning(f"Impossibile monitorare {dir_path}, resta in polling: {e}")
+            return
+        with self._lock:
+            self._hot[dir_path] = [watch, time.monotonic()]
+        logger.debug(f"Directory promossa a calda: {dir_path}")
+        if rescan:
+            self._refresh(dir_path)
+
+    def _refresh(self, dir_path):
+        """Rilegge la directory e consegna i cambiamenti non già visti dagli eventi nativi"""
+        changes = []
+        self.scanner.scan_dir(dir_path, changes)
+        with self._lock:
+            seen = set(self._seen)
+        self._deliver(changes, seen)
+
+    def _deliver(self, changes, seen):
+        """Consegna i cambiamenti rilevati dallo scanner e restituisce le directory coinvolte"""
+        active_dirs = set()
+        for event_type, file_path in changes:
+            if file_path in seen:
+                continue
+            if event_type == 'deleted':
+                self.handler.process_event(event_type, file_path)
+            else:
+                self.handler.process_write_event(event_type, file_path)
+            active_dirs.add(os.path.dirname(file_path))
+        return active_dirs
+
+    def _demote(self, dir_path, refresh=True):
+        """
+        Rimuove il watch nativo della directory.
+
+        Prima di rimuovere il watch la directory viene riletta: i cambiamenti non ancora
+        consegnati dagli eventi nativi dall'ultimo polling vengono consegnati ora, così lo
+        snapshot resta allineato quando la directory torna fredda.
+        """
+        if refresh:
+            self._refresh(dir_path)
+        with self._lock:
+            entry = self._hot.pop(dir_path, None)
+        if entry is None:
+            return
+        try:
+            self.observer.unschedule(entry[0])
+        except (KeyError, OSError):
+            pass
+        logger.debug(f"Directory retrocessa a fredda: {dir_path}")
+
+    def record_activity(self, event):
+        """Chiamato dal thread dell'observer per ogni evento nativo"""
+        path = getattr(event, 'dest_path', None) or event.src_path
+        with self._lock:
+            if event.is_directory:
+                if event.event_type in ('created', 'moved'):
+                    # I file arriveranno probabilmente nella nuova directory
+                    self._to_promote.add(path)
+                return
+            self._seen.add(path)
+            entry = self._hot.get(os.path.dirname(path))
+            if entry is not None:
+                entry[1] = time.monotonic()
+                self._hot.move_to_end(os.path.dirname(path))
+
+    def maintain(self):
+        """Applica le promozioni richieste e retrocede le directory inattive"""
+        with self._lock:
+            to_promote = self._to_promote
+            self._to_promote = set()
+        for dir_path in to_promote:
+            self.promote(dir_path)
+
+        now = time.monotonic()
+        with self._lock:
+            idle = [dir_path for dir_path, (_, last_activity) in self._hot.items()
+                    if dir_path not in self._pinned and now - last_activity > self.hot_ttl]
+        for dir_path in idle:
+            self._demote(dir_path)
+
+    def poll_cold(self):
+        """
+        Scansione a polling: consegna i cambiamenti non già visti dai watch nativi.
+
+        Anche le directory calde vengono rilette per intero (al massimo max_hot_dirs): così
+        le nuove sottodirectory vengono scoperte e lo snapshot resta allineato con quanto
+        già consegnato dagli eventi nativi, che dall'ultimo polling finiscono in _seen.
+        """
+        with self._lock:
+            hot_dirs = set(self._hot)
+        changes = self.scanner.scan(full_dirs=hot_dirs)
+        with self._lock:
+            seen = self._seen
+            self._seen = set()
+
+        for dir_path in self._deliver(changes, seen):
+            self.promote(dir_path)
+
+    def stop(self):
+        for dir_path in self.hot_dirs:
+            self._demote(dir_path, refresh=False)
 
 
 class DirectoryListener(BaseListener):
@@ -97,6 +1664,16 @@ class DirectoryListener(BaseListener):
         self.watch_path = event_config.get("watch_path", ".")
         self.recursive = event_config.get("recursive", True)
         self.poll_interval = event_config.get("poll_interval", 1.0)
+        self.metrics_interval = float(event_config.get("metrics_interval", 60))
+        self.event_handler = None
+        self.watcher = None
+        self.backfill = None
+
+        # Backend: 'watchdog' (watch ricorsivo su tutto l'albero) o 'hybrid'
+        self.backend = event_config.get("backend", "watchdog")
+        if self.backend not in ("watchdog", "hybrid"):
+            raise ValueError(f"backend non valido: {self.backend} (valori ammessi: watchdog, hybrid)")
+        self.cold_poll_interval = float(event_config.get("cold_poll_interval", 60))
         
     def listen(self, config_file):
         """
@@ -113,39 +1690,137 @@ class DirectoryListener(BaseListener):
             logger.error(f"Directory non trovata: {self.watch_path}")
             return
             
+        # Configura l'observer
+        observer = Observer()
+        snapshot_store = open_snapshot_store(self.event_config, self.watch_path)
+
         # Crea l'handler per gli eventi
-        event_handler = DirectoryEventHandler(
+        handler_class = HybridEventHandler if self.backend == "hybrid" else DirectoryEventHandler
+        event_handler = handler_class(
             config_file, 
             self.global_context, 
-            self.event_config
-        )
-        
-        # Configura l'observer
-        observer = Observer()
-        observer.schedule(
-            event_handler, 
-            self.watch_path, 
-            recursive=self.recursive
+            self.event_config,
+            close_events=InotifyObserver is not None and isinstance(observer, InotifyObserver),
+            snapshot_store=snapshot_store
         )
+        self.event_handler = event_handler
+        if event_handler.wait_for_write_complete:
+            mode = "eventi di chiusura (inotify)" if event_handler.close_events else "controllo stabilità size/mtime"
+            logger.info(f"Attesa completamento scrittura: {mode}")
+
+        if self.backend == "watchdog":
+            observer.schedule(
+                event_handler, 
+                self.watch_path, 
+                recursive=self.recursive
+            )
         
         try:
             # Avvia il monitoraggio
             observer.start()
             logger.info("Monitoraggio directory avviato. Premi Ctrl+C per fermare.")
+
+            if self.backend == "hybrid":
+                self.watcher = HybridWatcher(
+                    observer,
+                    event_handler,
+                    self.create_scanner(event_handler, skip_unchanged_dirs=True),
+                    max_hot_dirs=self.event_config.get("max_hot_dirs", 1000),
+                    hot_ttl=self.event_config.get("hot_ttl", 300)
+                )
+                # La radice resta sempre calda; il suo stato di riferimento arriva dalla
+                # scansione iniziale qui sotto
+                self.watcher.promote(os.path.normpath(self.watch_path), pinned=True, rescan=False)
+                logger.info(f"Backend ibrido: polling delle directory fredde ogni {self.cold_poll_interval}s")
+
+            if snapshot_store:
+                # L'observer è già attivo: i cambiamenti durante il recupero non vanno persi
+                self.catch_up(event_handler, snapshot_store, self.watcher.scanner if self.watcher else None)
+            elif self.watcher:
+                # Scansione iniziale silenziosa dello stato di riferimento
+                self.watcher.scanner.scan()
+
+            self.backfill = create_backfill(
+                self.event_config, self.watch_path, event_handler.should_process_file,
+                event_handler.dispatcher, self.recursive
+            )
+            if self.backfill:
+                event_handler.backfill = self.backfill
+                self.backfill.start()
             
             # Mantieni il processo attivo
+            last_metrics = time.monotonic()
+            last_cold_poll = time.monotonic()
             while True:
                 time.sleep(self.poll_interval)
+                event_handler.check_pending_writes()
+                if self.watcher:
+                    self.watcher.maintain()
+                    if time.monotonic() - last_cold_poll >= self.cold_poll_interval:
+                        self.watcher.poll_cold()
+                        last_cold_poll = time.monotonic()
+                if self.metrics_interval > 0 and time.monotonic() - last_metrics >= self.metrics_interval:
+                    event_handler.dispatcher.log_metrics()
+                    if self.backfill and self.backfill.active:
+                        self.backfill.log_progress()
+                    last_metrics = time.monotonic()
                 
         except KeyboardInterrupt:
             logger.info("Interruzione richiesta dall'utente")
         except Exception as e:
             logger.error(f"Errore durante il monitoraggio: {e}")
         finally:
+            if self.backfill:
+                self.backfill.stop()
+            if self.watcher:
+                self.watcher.stop()
             observer.stop()
             observer.join()
+            event_handler.stop()
+            if snapshot_store:
+                snapshot_store.close()
             logger.info("Monitoraggio directory terminato")
 
+    def get_metrics(self):
+        """Metriche del pool di worker (profondità code e ritardo di elaborazione)"""
+        return self.event_handler.dispatcher.metrics() if self.event_handler else {}
+
+    def create_scanner(self, event_handler, skip_unchanged_dirs=False):
+        """Crea uno scanner con gli stessi filtri dell'handler"""
+        return IncrementalScanner(
+            self.watch_path,
+            event_handler.should_process_file,
+            skip_unchanged_dirs=skip_unchanged_dirs,
+            full_scan_every=self.event_config.get("full_scan_every", 10),
+            recursive=self.recursive,
+            content_hash=bool(self.event_config.get("content_hash", False))
+        )
+
+    def catch_up(self, event_handler, snapshot_store, scanner=None):
+        """Confronta lo snapshot salvato con il disco e processa i cambiamenti mancati"""
+        snapshot = snapshot_store.load()
+        if scanner is None:
+            scanner = self.create_scanner(event_handler)
+        if snapshot is not None:
+            scanner.snapshot = snapshot
+        changes = scanner.scan()
+        if snapshot is None:
+            # Primo avvio: lo stato attuale diventa il riferimento
+            snapshot_store.save(scanner.snapshot)
+            logger.info(f"Snapshot iniziale salvato ({len(scanner.snapshot)} file)")
+            return
+        # I cambiamenti esclusi da 'events' non verranno mai processati: si registrano
+        # subito, altrimenti verrebbero rilevati di nuovo a ogni riavvio
+        snapshot_store.save_changes(
+            scanner.snapshot, [change for change in changes if change[0] not in event_handler.events]
+        )
+        # Gli altri vengono registrati dai worker dopo l'esecuzione del flusso
+        run_catch_up(
+            [change for change in changes if change[0] in event_handler.events],
+            event_handler.process_catch_up,
+            rate=float(self.event_config.get("catchup_rate", 10))
+        )
+
 
 class PollingDirectoryListener(BaseListener):
     """
@@ -159,90 +1834,139 @@ class PollingDirectoryListener(BaseListener):
         self.poll_interval = event_config.get("poll_interval", 5.0)
         self.file_patterns = event_config.get("file_patterns", ["*"])
         self.ignore_patterns = event_config.get("ignore_patterns", [])
-        self.last_scan = {}
+        self.matcher = PatternMatcher(self.file_patterns, self.ignore_patterns, self.watch_path)
+        self.events = frozenset(event_config.get("events", DEFAULT_EVENTS))
+        self.scanner = IncrementalScanner(
+            self.watch_path,
+            self.should_process_file,
+            skip_unchanged_dirs=bool(event_config.get("incremental_scan", False)),
+            full_scan_every=event_config.get("full_scan_every", 10),
+            content_hash=bool(event_config.get("content_hash", False))
+        )
+        self.write_tracker = None
+        if event_config.get("wait_for_write_complete", False):
+            self.write_tracker = WriteCompletionTracker(event_config.get("stable_checks", 2))
+        self.snapshot_store = None
+        self.dispatcher = None
+        self.metrics_interval = float(event_config.get("metrics_interval", 60))
+        self.config_file = None
+
+        # Modalità batch: i cambiamenti vengono accumulati e consegnati in blocco
+        self.batch_mode = bool(event_config.get("batch_mode", False))
+        self.batch_window = float(event_config.get("batch_window", 5))
+        self.batch_size = max(1, int(event_config.get("batch_size", 1000)))
+        self._batch = OrderedDict()
+        self._batch_started = None
+        self.backfill = None
         
     def should_process_file(self, file_path):
         """Verifica se il file deve essere processato in base ai pattern"""
-        import fnmatch
-        file_name = os.path.basename(file_path)
-        
-        # Verifica pattern di esclusione
-        for ignore_pattern in self.ignore_patterns:
-            if fnmatch.fnmatch(file_name, ignore_pattern):
-                return False
-                
-        # Verifica pattern di inclusione
-        for pattern in self.file_patterns:
-            if fnmatch.fnmatch(file_name, pattern):
-                return True
-                
-        return False
+        return self.matcher.matches(file_path)
+
+    def filter_events(self, changes):
+        """Scarta i cambiamenti il cui tipo di evento non è tra quelli configurati"""
+        return [change for change in changes or [] if change[0] in self.events]
     
     def scan_directory(self):
         """Scansiona la directory e rileva i cambiamenti"""
-        current_scan = {}
-        
         try:
-            for root, dirs, files in os.walk(self.watch_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    if self.should_process_file(file_path):
-                        try:
-                            stat = os.stat(file_path)
-                            current_scan[file_path] = {
-                                'mtime': stat.st_mtime,
-                                'size': stat.st_size
-                            }
-                        except OSError:
-                            # File potrebbe essere stato eliminato durante la scansione
-                            continue
+            return self.scanner.scan()
         except Exception as e:
             logger.error(f"Errore durante la scansione della directory: {e}")
             return
-        
-        # Rileva i cambiamenti
-        changes = []
-        
-        # File nuovi o modificati
-        for file_path, info in current_scan.items():
-            if file_path not in self.last_scan:
-                changes.append(('created', file_path))
-            elif (self.last_scan[file_path]['mtime'] != info['mtime'] or 
-                  self.last_scan[file_path]['size'] != info['size']):
-                changes.append(('modified', file_path))
-        
-        # File eliminati
-        for file_path in self.last_scan:
-            if file_path not in current_scan:
-                changes.append(('deleted', file_path))
-        
-        self.last_scan = current_scan
-        return changes
     
+    def filter_incomplete_writes(self, changes):
+        """
+        Trattiene created/modified finché la scrittura del file non è completa
+        e restituisce i cambiamenti pronti per essere processati.
+        """
+        ready = []
+        for event_type, file_path in changes:
+            if event_type in ('created', 'modified'):
+                self.write_tracker.observe(event_type, file_path)
+            elif event_type == 'deleted' and self.write_tracker.discard(file_path) == 'created':
+                # Il flusso non ha mai visto il file: nessun evento da segnalare
+                continue
+            else:
+                ready.append((event_type, file_path))
+        ready.extend(self.write_tracker.check())
+        return ready
+
     def process_change(self, event_type, file_path, config_file):
-        """Processa un cambiamento rilevato"""
+        """Accoda l'elaborazione di un cambiamento rilevato"""
         logger.info(f"Evento {event_type} rilevato per: {file_path}")
-        
-        try:
-            # Carica la configurazione del flusso
-            with open(config_file, 'r') as file:
-                config = safe_load(file)
-            
-            # Crea il flusso con le variabili dell'evento
-            flow = FlowDiagram(config, self.global_context)
-            flow.variables.update({
-                'event_type': event_type,
-                'file_path': file_path,
-                'file_name': os.path.basename(file_path),
-                'file_dir': os.path.dirname(file_path),
-                'timestamp': time.time()
-            })
-            
-            # Esegui il flusso
-            flow.run()
-            
-        except Exception as e:
-            logger.error(f"Errore durante l'elaborazione dell'evento {event_type} per {file_path}: {e}")
+        self.dispatcher.submit(
+            file_path, event_variables(event_type, file_path), self.snapshot_saver([(event_type, file_path)])
+        )
+
+    def snapshot_saver(self, changes):
+        """
+        Callback che persiste i cambiamenti dopo l'elaborazione riuscita del flusso, con
+        lo stato rilevato dalla scansione; un'interruzione prima verrà recuperata al riavvio
+        """
+        if not self.snapshot_store:
+            return None
+        snapshot = self.scanner.snapshot
+        rows = [(event_type, file_path, snapshot.get(file_path), snapshot.get_hash(file_path))
+                for event_type, file_path in changes]
+
+        def on_done():
+            for event_type, file_path, info, content_hash in rows:
+                if event_type == 'deleted' or info is None:
+                    self.snapshot_store.forget(file_path)
+                else:
+                    self.snapshot_store.record(file_path, content_hash, info)
+        return on_done
+
+    def queue_change(self, event_type, file_path):
+        """Accoda un cambiamento al batch in corso oppure direttamente ai worker"""
+        if self.backfill:
+            self.backfill.mark_live(file_path)
+        if not self.batch_mode:
+            self.process_change(event_type, file_path, self.config_file)
+            return
+
+        previous = self._batch.pop(file_path, None)
+        if previous is not None:
+            event_type = EventDebouncer._coalesce(previous, event_type)
+            if event_type is None:
+                return
+        if not self._batch:
+            self._batch_started = time.monotonic()
+        self._batch[file_path] = event_type
+
+    def flush_changes(self, changes, force=False):
+        """
+        Consegna il batch se la finestra è scaduta o è pieno, senza attendere i worker.
+        I cambiamenti consegnati vengono persistiti dai worker a flusso completato (vedi
+        snapshot_saver): finché il batch è aperto non vengono persistiti, così
+        un'interruzione non li perde. Quelli esclusi da 'events' vengono persistiti subito.
+        """
+        if self.snapshot_store and changes:
+            ignored = [change for change in changes if change[0] not in self.events]
+            self.snapshot_store.save_changes(self.scanner.snapshot, ignored)
+
+        if self._batch:
+            ready = (force
+                     or len(self._batch) >= self.batch_size
+                     or time.monotonic() - self._batch_started >= self.batch_window)
+            if not ready:
+                return
+            batch = list(self._batch.items())
+            self._batch.clear()
+            for start in range(0, len(batch), self.batch_size):
+                chunk = batch[start:start + self.batch_size]
+                logger.info(f"Batch di {len(chunk)} eventi pronto per l'elaborazione")
+                # Chiave unica: i batch vengono processati in ordine uno dopo l'altro
+                self.dispatcher.submit(
+                    self.watch_path,
+                    batch_variables(chunk),
+                    self.snapshot_saver([(event_type, file_path) for file_path, event_type in chunk])
+                )
+
+    def get_metrics(self):
+        """Metriche del pool di worker (profondità code e ritardo di elaborazione)"""
+        return self.dispatcher.metrics() if self.dispatcher else {}
     
     def listen(self, config_file):
         """
@@ -258,22 +1982,59 @@ class PollingDirectoryListener(BaseListener):
             logger.error(f"Directory non trovata: {self.watch_path}")
             return
         
-        # Scansione iniziale
-        self.scan_directory()
+        self.config_file = config_file
+        self.dispatcher = create_dispatcher(self.event_config, config_file, self.global_context)
+        self.snapshot_store = open_snapshot_store(self.event_config, self.watch_path)
+        saved_snapshot = self.snapshot_store.load() if self.snapshot_store else None
+        if saved_snapshot is not None:
+            self.scanner.snapshot = saved_snapshot
+        
+        # Scansione iniziale: silenziosa, oppure di recupero se esiste uno snapshot salvato
+        changes = self.scan_directory()
+        if saved_snapshot is not None:
+            run_catch_up(
+                self.filter_events(changes),
+                self.queue_change,
+                rate=float(self.event_config.get("catchup_rate", 10))
+            )
+            self.flush_changes(changes, force=True)
+        elif self.snapshot_store:
+            self.snapshot_store.save(self.scanner.snapshot)
         logger.info("Scansione iniziale completata")
+
+        self.backfill = create_backfill(
+            self.event_config, self.watch_path, self.should_process_file, self.dispatcher
+        )
+        if self.backfill:
+            self.backfill.start()
         
+        last_metrics = time.monotonic()
         try:
             while True:
                 time.sleep(self.poll_interval)
                 
                 changes = self.scan_directory()
-                if changes:
-                    for event_type, file_path in changes:
-                        self.process_change(event_type, file_path, config_file)
+                if self.write_tracker:
+                    # Le scritture trattenute vengono persistite solo quando sono consegnate
+                    changes = self.filter_incomplete_writes(changes or [])
+                for event_type, file_path in self.filter_events(changes):
+                    self.queue_change(event_type, file_path)
+                self.flush_changes(changes)
+                if self.metrics_interval > 0 and time.monotonic() - last_metrics >= self.metrics_interval:
+                    self.dispatcher.log_metrics()
+                    if self.backfill and self.backfill.active:
+                        self.backfill.log_progress()
+                    last_metrics = time.monotonic()
                         
         except KeyboardInterrupt:
             logger.info("Interruzione richiesta dall'utente")
         except Exception as e:
             logger.error(f"Errore durante il monitoraggio: {e}")
         finally:
+            self.flush_changes([], force=True)
+            if self.backfill:
+                self.backfill.stop()
+            self.dispatcher.stop()
+            if self.snapshot_store:
+                self.snapshot_store.close()
             logger.info("Monitoraggio directory terminato")
@@ -3,6 +3,7 @@ import requests
 import json
 from datetime import datetime
 from .base_state import BaseState
+from . import http_client
 
 logger = logging.getLogger(__name__)
 
@@ -145,7 +146,8 @@ class ElevenLabsBatchCallingState(BaseState):
             logger.info(f"Invio richiesta batch call per {len(formatted_recipients)} recipients")
             logger.debug(f"Payload: {json.dumps(payload, indent=2)}")
             
-            response = requests.post(api_url, json=payload, headers=headers)
+            # Solo le risposte che garantiscono che il batch non è stato creato vengono ripetute
+            response = http_client.post(api_url, json=payload, headers=headers, retry_statuses=(429, 503))
             response.raise_for_status()
             
             result = response.json()
@@ -185,7 +187,7 @@ class ElevenLabsBatchCallingState(BaseState):
         try:
             logger.info(f"Recupero informazioni per batch ID: {batch_id}")
             
-            response = requests.get(api_url, headers=headers)
+            response = http_client.get(api_url, headers=headers)
             response.raise_for_status()
             
             result = response.json()
@@ -226,7 +228,7 @@ class ElevenLabsBatchCallingState(BaseState):
         try:
             logger.info(f"Lista batch calls con limite: {limit}")
             
-            response = requests.get(api_url, headers=headers, params=params)
+            response = http_client.get(api_url, headers=headers, params=params)
             response.raise_for_status()
             
             result = response.json()
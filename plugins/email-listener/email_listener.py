@@ -3,6 +3,7 @@ import imaplib
 import email
 from email.header import decode_header
 import time
+from datetime import date, datetime, timedelta
 from yaml import safe_load
 
 # Importazioni dal nostro framework
@@ -29,10 +30,86 @@ class EmailListener(BaseListener):
         self.password = self.format_recursive(self.event_config.get("password"), self.global_context)
         self.folder = self.format_recursive(self.event_config.get("folder", "inbox"), self.global_context)
         self.poll_interval = int(self.event_config.get("poll_interval", 60))  # in secondi
+        # Filtri dichiarativi, tradotti in una query IMAP SEARCH eseguita lato server
+        self.filters = self.format_recursive(self.event_config.get("filters", {}), self.global_context) or {}
+        # Valida i filtri subito; la query viene ricostruita a ogni controllo
+        # perché i valori relativi di since/before (giorni fa) seguono la data corrente
+        self.build_search_criteria(self.filters)
         # Aggiungo un controllo per verificare che la configurazione essenziale sia presente
         if not all([self.server, self.username, self.password]):
             raise ValueError("Configurazione per EmailListener incompleta. 'server', 'username', e 'password' sono richiesti.")
 
+    @staticmethod
+    def _quote(value):
+        """Quota una stringa per la sintassi IMAP (RFC 3501 quoted string)."""
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        return f'"{value}"'
+
+    @staticmethod
+    def _imap_date(value):
+        """
+        Converte una data nel formato IMAP (es. 01-Jan-2024).
+        Accetta oggetti date/datetime, stringhe ISO (YYYY-MM-DD), stringhe già
+        in formato IMAP o un intero che indica quanti giorni fa.
+        """
+        if isinstance(value, datetime):
+            value = value.date()
+        elif isinstance(value, int):
+            value = date.today() - timedelta(days=value)
+        elif isinstance(value, str):
+            value = value.strip()
+            if value.lstrip('-').isdigit():
+                value = date.today() - timedelta(days=int(value))
+            else:
+                try:
+                    value = date.fromisoformat(value)
+                except ValueError:
+                    # Assume che la stringa sia già nel formato IMAP
+                    datetime.strptime(value, "%d-%b-%Y")
+                    return value
+        # strftime('%b') dipende dal locale: IMAP richiede i mesi in inglese
+        months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                  "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+        return f"{value.day:02d}-{months[value.month - 1]}-{value.year}"
+
+    @classmethod
+    def build_search_criteria(cls, filters):
+        """
+        Compila i filtri dichiarativi in una lista di criteri IMAP SEARCH.
+        Restituisce la tupla (charset, criteri); charset è 'UTF-8' solo se
+        qualche valore contiene caratteri non ASCII, altrimenti None.
+
+        Filtri supportati: from, to, cc, subject, body, since, before,
+        larger, smaller, headers (dizionario nome -> valore contenuto).
+        """
+        criteria = ['UNSEEN']
+        text_keys = {"from": "FROM", "to": "TO", "cc": "CC", "subject": "SUBJECT", "body": "BODY"}
+        unknown = set(filters) - set(text_keys) - {"since", "before", "larger", "smaller", "headers"}
+        if unknown:
+            raise ValueError(f"Filtri EmailListener non supportati: {', '.join(sorted(unknown))}")
+
+        for key, keyword in text_keys.items():
+            value = filters.get(key)
+            if value:
+                criteria.extend([keyword, cls._quote(value)])
+
+        if filters.get("since") is not None:
+            criteria.extend(["SINCE", cls._imap_date(filters["since"])])
+        if filters.get("before") is not None:
+            criteria.extend(["BEFORE", cls._imap_date(filters["before"])])
+        if filters.get("larger") is not None:
+            criteria.extend(["LARGER", str(int(filters["larger"]))])
+        if filters.get("smaller") is not None:
+            criteria.extend(["SMALLER", str(int(filters["smaller"]))])
+
+        for header_name, header_value in (filters.get("headers") or {}).items():
+            criteria.extend(["HEADER", cls._quote(header_name), cls._quote(header_value)])
+
+        if all(c.isascii() for c in criteria):
+            return None, criteria
+        # imaplib codifica gli argomenti in ASCII: i valori non ASCII vanno passati come bytes
+        return 'UTF-8', [c.encode('utf-8') for c in criteria]
+
     def check_email(self):
         """
         Si connette al server IMAP e controlla l'ultima email non letta.
@@ -42,7 +119,9 @@ class EmailListener(BaseListener):
         mail.login(self.username, self.password)
         mail.select(self.folder)
 
-        status, messages = mail.search(None, 'UNSEEN')
+        # Il filtraggio avviene lato server: vengono scaricate solo le email che corrispondono
+        search_charset, search_criteria = self.build_search_criteria(self.filters)
+        status, messages = mail.search(search_charset, *search_criteria)
         if status != "OK" or not messages[0]:
             mail.logout()
             return None
@@ -0,0 +1,197 @@
+"""
+HTTP Client condiviso per i plugin IntellyHub
+Pool di connessioni per host con keep-alive, timeout di default, retry con backoff
+e metriche delle richieste, usato dagli stati che chiamano API REST
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Timeout di default (connessione, lettura) in secondi
+DEFAULT_TIMEOUT = (5, 60)
+# Stati HTTP per cui la richiesta viene ripetuta
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Per i metodi non idempotenti solo gli stati che garantiscono che la richiesta non è stata
+# eseguita: dopo un 5xx o un timeout un messaggio potrebbe essere già stato inviato
+NON_IDEMPOTENT_RETRY_STATUSES = frozenset({429})
+# Metodi che possono essere ripetuti anche dopo un errore di rete a richiesta inviata
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+# Connessioni mantenute aperte per ogni host
+POOL_MAXSIZE = 20
+# Host con una sessione aperta: oltre il limite viene chiusa quella usata meno di recente
+MAX_SESSIONS = 32
+
+_sessions: "OrderedDict[str, requests.Session]" = OrderedDict()
+_sessions_lock = threading.Lock()
+_metrics: Dict[str, Dict[str, Any]] = {}
+_metrics_lock = threading.Lock()
+
+
+def _host_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url: str) -> requests.Session:
+    """
+    Restituisce la sessione condivisa per l'host dell'URL.
+
+    Le connessioni restano aperte e vengono riutilizzate dalle richieste successive
+    verso lo stesso host, anche da stati e flussi diversi dello stesso processo. Le
+    sessioni aperte sono al massimo MAX_SESSIONS (ad esempio con download da molti host
+    diversi): oltre il limite viene chiusa quella usata meno di recente.
+    """
+    key = _host_key(url)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None:
+            _sessions.move_to_end(key)
+            return session
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions[key] = session
+        evicted = _sessions.popitem(last=False)[1] if len(_sessions) > MAX_SESSIONS else None
+    # Le richieste ancora in corso sulla sessione chiusa terminano normalmente
+    if evicted is not None:
+        evicted.close()
+    return session
+
+
+def retry_delay(attempt: int, backoff: float, max_backoff: float, response: Optional[requests.Response] = None) -> float:
+    """
+    Attesa prima del tentativo successivo.
+
+    Usa l'header Retry-After se presente, altrimenti un backoff esponenziale con
+    jitter completo, così più client non ripetono la richiesta nello stesso istante.
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), max_backoff)
+            except ValueError:
+                pass
+    return random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+
+
+def _record(host: str, latency: float, sent: int, received: int, error: bool = False, retried: bool = False):
+    with _metrics_lock:
+        metrics = _metrics.setdefault(host, {
+            "requests": 0,
+            "errors": 0,
+            "retries": 0,
+            "total_latency": 0.0,
+            "max_latency": 0.0,
+            "bytes_sent": 0,
+            "bytes_received": 0
+        })
+        metrics["requests"] += 1
+        metrics["errors"] += int(error)
+        metrics["retries"] += int(retried)
+        metrics["total_latency"] += latency
+        metrics["max_latency"] = max(metrics["max_latency"], latency)
+        metrics["bytes_sent"] += sent
+        metrics["bytes_received"] += received
+
+
+def _body_size(body: Any) -> int:
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    return 0
+
+
+def request(method: str, url: str, timeout: Union[float, Tuple[float, float], None] = DEFAULT_TIMEOUT,
+            retries: int = 3, backoff: float = 0.5, max_backoff: float = 30.0,
+            retry_statuses=None, **kwargs) -> requests.Response:
+    """
+    Esegue una richiesta HTTP con la sessione condivisa dell'host.
+
+    Per i metodi idempotenti le risposte 429 e 5xx vengono ripetute fino a retries volte
+    con backoff, per gli altri (POST, PATCH) solo le 429, salvo retry_statuses esplicito;
+    gli errori di connessione vengono ripetuti per i metodi idempotenti (e per tutti in
+    caso di timeout di connessione). Restituisce l'ultima risposta: il controllo dello stato
+    (ad esempio raise_for_status) resta al chiamante, come con requests.
+
+    Args:
+        method: Metodo HTTP
+        url: URL della richiesta
+        timeout: Timeout (connessione, lettura) in secondi
+        retries: Numero massimo di ripetizioni
+        backoff: Attesa base in secondi per il backoff esponenziale
+        max_backoff: Attesa massima tra due tentativi
+        retry_statuses: Stati HTTP da ripetere; indicarli per un metodo non idempotente
+            significa accettare che la richiesta possa essere eseguita più volte
+        **kwargs: Parametri passati a requests (params, json, data, files, headers, stream, ...)
+    """
+    method = method.upper()
+    if retry_statuses is None:
+        retry_statuses = RETRY_STATUSES if method in IDEMPOTENT_METHODS else NON_IDEMPOTENT_RETRY_STATUSES
+    host = _host_key(url)
+    session = get_session(url)
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            latency = time.monotonic() - started
+            # Un timeout di connessione garantisce che la richiesta non è partita
+            can_retry = attempt < retries and (
+                isinstance(e, requests.exceptions.ConnectTimeout)
+                or (isinstance(e, requests.exceptions.ConnectionError) and method in IDEMPOTENT_METHODS)
+            )
+            _record(host, latency, 0, 0, error=True, retried=can_retry)
+            if not can_retry:
+                raise
+            delay = retry_delay(attempt, backoff, max_backoff)
+            logger.warning(f"Errore di rete verso {host}: {e}, nuovo tentativo tra {delay:.1f}s")
+        else:
+            latency = time.monotonic() - started
+            sent = _body_size(response.request.body)
+            # Con stream=True il corpo non è ancora stato letto: si usa Content-Length
+            if kwargs.get("stream"):
+                received = int(response.headers.get("Content-Length", 0) or 0)
+            else:
+                received = len(response.content)
+            can_retry = response.status_code in retry_statuses and attempt < retries
+            _record(host, latency, sent, received, error=response.status_code >= 400, retried=can_retry)
+            if not can_retry:
+                return response
+            delay = retry_delay(attempt, backoff, max_backoff, response)
+            logger.warning(f"Risposta {response.status_code} da {host}, nuovo tentativo tra {delay:.1f}s")
+            response.close()
+        attempt += 1
+        time.sleep(delay)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Richiesta GET con la sessione condivisa (vedi request)"""
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """Richiesta POST con la sessione condivisa (vedi request)"""
+    return request("POST", url, **kwargs)
+
+
+def get_metrics() -> Dict[str, Dict[str, Any]]:
+    """Metriche per host: richieste, errori, retry, latenza media/massima e byte trasferiti"""
+    with _metrics_lock:
+        result = {}
+        for host, metrics in _metrics.items():
+            result[host] = dict(metrics, avg_latency=metrics["total_latency"] / metrics["requests"])
+        return result
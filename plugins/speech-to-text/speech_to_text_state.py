@@ -6,6 +6,7 @@ import tempfile
 from datetime import datetime
 from urllib.parse import urlparse
 from .base_state import BaseState
+from . import http_client
 
 logger = logging.getLogger(__name__)
 
@@ -136,7 +137,7 @@ class SpeechToTextState(BaseState):
     def _download_audio_file(self, url, workspace_path):
         """Scarica un file audio da URL."""
         try:
-            response = requests.get(url, stream=True, timeout=30)
+            response = http_client.get(url, stream=True, timeout=30)
             response.raise_for_status()
             
             # Determina l'estensione del file dall'URL o Content-Type
@@ -1,15 +1,444 @@
 """
 Telegram Bot Plugin per IntellyHub
-Permette di inviare messaggi tramite bot Telegram
+Permette di inviare messaggi, foto, documenti e messaggi vocali tramite bot Telegram
 """
 
 import requests
 import logging
-from typing import Dict, Any, Optional
+import heapq
+import io
+import itertools
+import mimetypes
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, Optional, Callable, List
 from flow.states.base_state import BaseState
+from . import http_client
 
 logger = logging.getLogger(__name__)
 
+# Lunghezza massima di un messaggio e di una didascalia (in unità UTF-16, come conta Telegram)
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+# Errori della Bot API che indicano un file_id non più utilizzabile; gli altri 400
+# (chat non trovata, bot bloccato, didascalia non valida) non dipendono dal file
+FILE_ID_ERRORS = (
+    'wrong file identifier',
+    'wrong remote file identifier',
+    'wrong file_id',
+    "can't use file of type",
+    'type of file mismatch',
+    'file reference expired'
+)
+# Tipi di file supportati: parametro di configurazione -> metodo della Bot API
+MEDIA_METHODS = {
+    'photo': 'sendPhoto',
+    'document': 'sendDocument',
+    'voice': 'sendVoice'
+}
+# Timeout (connessione, lettura) per il caricamento dei file
+UPLOAD_TIMEOUT = (5, 120)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# file_id memorizzati: oltre il limite viene scartato quello usato meno di recente
+MAX_FILE_IDS = 1000
+
+HTML_TOKEN = re.compile(r'<[^>]*>|&#?\w+;|[^<&]+|[<&]')
+MARKDOWN_TOKEN = re.compile(r'```[^\n`]*\n?|\\.|\[[^\]\n]*\]\([^)\n]*\)|[*_`]|[^\\*_`\[]+|.', re.DOTALL)
+MARKDOWN_V2_TOKEN = re.compile(r'```[^\n`]*\n?|\\.|\[[^\]\n]*\]\([^)\n]*\)|__|\|\||[*_~`]|[^\\*_~`|\[]+|.', re.DOTALL)
+
+
+def text_length(text: str) -> int:
+    """Lunghezza del testo in unità UTF-16 (le emoji contano 2)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _fit(text: str, room: int) -> int:
+    """Numero di caratteri iniziali di text che occupano al massimo room unità UTF-16"""
+    used = 0
+    for index, char in enumerate(text):
+        used += 2 if ord(char) > 0xFFFF else 1
+        if used > room:
+            return index
+    return len(text)
+
+
+def _tokenize(text: str, parse_mode: Optional[str]):
+    """
+    Divide il testo in token (tipo, testo, chiave).
+    
+    I tipi sono 'text' (divisibile), 'atom' (entità, escape e link da non spezzare),
+    'open' e 'close' (tag HTML o marcatori Markdown di formattazione).
+    """
+    mode = (parse_mode or '').lower()
+    if mode == 'html':
+        for token in HTML_TOKEN.findall(text):
+            tag = re.match(r'<(/?)([\w-]+)', token)
+            if tag and token.endswith('>'):
+                name = tag.group(2).lower()
+                if tag.group(1):
+                    yield 'close', token, name
+                elif token.endswith('/>'):
+                    yield 'atom', token, None
+                else:
+                    yield 'open', token, name
+            elif token.startswith('&') and token.endswith(';'):
+                yield 'atom', token, None
+            else:
+                yield 'text', token, None
+    elif mode in ('markdown', 'markdownv2'):
+        pattern = MARKDOWN_V2_TOKEN if mode == 'markdownv2' else MARKDOWN_TOKEN
+        for token in pattern.findall(text):
+            if token.startswith('```'):
+                yield 'marker', token, '```'
+            elif token in ('*', '_', '`', '__', '~', '||'):
+                yield 'marker', token, token
+            elif token.startswith('\\') or (token.startswith('[') and len(token) > 1):
+                yield 'atom', token, None
+            else:
+                yield 'text', token, None
+    else:
+        yield 'text', text, None
+
+
+def split_message(text: str, parse_mode: Optional[str] = None, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    Divide un messaggio lungo in parti di al massimo limit caratteri.
+    
+    Le parti vengono separate preferibilmente tra paragrafi, poi tra righe e parole; tag
+    HTML, entità ed escape non vengono mai spezzati e la formattazione aperta viene
+    chiusa alla fine di una parte e riaperta all'inizio della successiva.
+    """
+    if not text or not text.strip():
+        return []
+    if text_length(text) <= limit:
+        return [text]
+    
+    chunks = []
+    # Formattazione aperta: (chiave, apertura, chiusura)
+    stack = []
+    # Formattazione abbandonata perché troppo lunga da riaprire: chiave -> chiusure da scartare
+    dropped = {}
+    current = ''
+    has_text = False
+    
+    def closing() -> str:
+        return ''.join(closer for _, _, closer in reversed(stack))
+    
+    def room() -> int:
+        return limit - text_length(current) - text_length(closing())
+    
+    def flush():
+        nonlocal current, has_text
+        if has_text:
+            chunks.append(current.rstrip(' ') + closing())
+        # La formattazione riaperta conta nel limite: se occupa più di metà della parte
+        # viene abbandonata, a partire dal tag più lungo (ad esempio un link con URL lungo)
+        while stack and text_length(''.join(opener + closer for _, opener, closer in stack)) > limit // 2:
+            entry = max(stack, key=lambda entry: text_length(entry[1] + entry[2]))
+            stack.remove(entry)
+            dropped[entry[0]] = dropped.get(entry[0], 0) + 1
+        current = ''.join(opener for _, opener, _ in stack)
+        has_text = False
+    
+    for kind, token, key in _tokenize(text, parse_mode):
+        # Nel codice Markdown gli altri marcatori sono testo normale
+        if kind == 'marker' and stack and stack[-1][0] in ('`', '```') and key != stack[-1][0]:
+            kind = 'text'
+        if kind == 'marker':
+            if any(entry[0] == key for entry in stack) or dropped.get(key):
+                kind = 'close'
+            else:
+                kind = 'open'
+        
+        if kind == 'open':
+            closer = '```' if key == '```' else (key if key in ('*', '_', '`', '__', '~', '||') else f'</{key}>')
+            if text_length(token) + text_length(closer) > room():
+                flush()
+                if text_length(token) + text_length(closer) > room():
+                    # Il tag non entra neanche in una parte nuova: il contenuto resta senza formattazione
+                    dropped[key] = dropped.get(key, 0) + 1
+                    continue
+            current += token
+            stack.append((key, token, closer))
+        elif kind == 'close':
+            for index in range(len(stack) - 1, -1, -1):
+                if stack[index][0] == key:
+                    del stack[index]
+                    current += token
+                    break
+            else:
+                if dropped.get(key):
+                    dropped[key] -= 1
+                else:
+                    current += token
+        elif kind == 'atom':
+            if text_length(token) > room():
+                flush()
+            current += token
+            has_text = True
+        else:
+            while token:
+                available = room()
+                if text_length(token) <= available:
+                    current += token
+                    has_text = has_text or bool(token.strip())
+                    break
+                size = _fit(token, max(available, 0))
+                cut = 0
+                for separator in ('\n\n', '\n', ' '):
+                    position = token.rfind(separator, 0, size)
+                    if position > 0:
+                        cut = position + len(separator)
+                        break
+                if not cut:
+                    # Nessun separatore: meglio andare a capo tra due token che spezzare una parola
+                    if has_text:
+                        flush()
+                        continue
+                    cut = max(size, 1)
+                current += token[:cut]
+                has_text = has_text or bool(token[:cut].strip())
+                token = token[cut:]
+                flush()
+                # Gli spazi all'inizio di una nuova parte vengono scartati
+                token = token.lstrip(' \n')
+    flush()
+    return chunks
+
+
+class MultipartFile:
+    """
+    Corpo multipart/form-data che legge il file dal disco a blocchi durante l'invio.
+    
+    La lunghezza totale è nota in anticipo, così requests imposta Content-Length e invia
+    il corpo senza caricarlo in memoria.
+    """
+    
+    def __init__(self, fields: Dict[str, Any], file_field: str, path: str):
+        boundary = uuid.uuid4().hex
+        filename = os.path.basename(path).replace('"', '')
+        mime_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        head = ''
+        for name, value in fields.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            head += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                 f'Content-Type: {mime_type}\r\n\r\n')
+        head = head.encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.len = len(head) + os.path.getsize(path) + len(tail)
+        self._parts = deque([io.BytesIO(head), open(path, 'rb'), io.BytesIO(tail)])
+    
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.len
+        data = b''
+        while self._parts and len(data) < size:
+            block = self._parts[0].read(min(size - len(data), UPLOAD_CHUNK_SIZE))
+            if block:
+                data += block
+            else:
+                self._parts.popleft().close()
+        return data
+    
+    def close(self):
+        while self._parts:
+            self._parts.popleft().close()
+
+
+# file_id dei file già caricati: (bot, metodo, percorso, dimensione, data di modifica) -> file_id
+_file_ids: "OrderedDict[tuple, str]" = OrderedDict()
+# Lock dei caricamenti in corso: [lock, chiamanti che lo usano], rimosso a caricamento finito
+_file_locks: Dict[tuple, list] = {}
+_file_ids_lock = threading.Lock()
+
+
+def _file_key(bot_token: str, method: str, path: str) -> tuple:
+    stat = os.stat(path)
+    return (bot_token, method, os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def _get_file_id(key: tuple) -> Optional[str]:
+    with _file_ids_lock:
+        file_id = _file_ids.get(key)
+        if file_id is not None:
+            _file_ids.move_to_end(key)
+        return file_id
+
+
+def _store_file_id(key: tuple, file_id: Optional[str]):
+    """Memorizza (o, con file_id None, scarta) il file_id di un file"""
+    with _file_ids_lock:
+        if file_id is None:
+            _file_ids.pop(key, None)
+            return
+        _file_ids[key] = file_id
+        _file_ids.move_to_end(key)
+        while len(_file_ids) > MAX_FILE_IDS:
+            _file_ids.popitem(last=False)
+
+
+@contextmanager
+def _file_lock(key: tuple):
+    """Serializza i caricamenti dello stesso file; il lock esiste solo finché qualcuno lo usa"""
+    with _file_ids_lock:
+        entry = _file_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _file_ids_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _file_locks[key]
+
+
+def _result_file_id(result: Dict[str, Any], field: str) -> Optional[str]:
+    """file_id del file contenuto nel messaggio inviato"""
+    message = result.get('result') or {}
+    # Telegram può classificare un documento come animazione, audio o video
+    for key in (field, 'document', 'animation', 'audio', 'video'):
+        media = message.get(key)
+        if media:
+            # Le foto arrivano in più dimensioni: l'ultima è l'originale
+            if isinstance(media, list):
+                media = media[-1]
+            return media.get('file_id')
+    return None
+
+
+class SendScheduler:
+    """
+    Coda di invio con i limiti di frequenza di Telegram, condivisa da tutto il processo.
+    
+    Ogni bot ha il proprio scheduler: un token bucket globale (messaggi al secondo) e un
+    intervallo minimo per chat, più lungo per gruppi e canali (chat_id negativo o @username,
+    che per i bot identifica sempre un canale o un supergruppo pubblico). I
+    messaggi della stessa chat vengono inviati in ordine, uno alla volta; chat diverse
+    procedono in parallelo. Se Telegram risponde 429 il messaggio viene rimesso in testa
+    alla coda e gli invii vengono sospesi per i secondi indicati in retry_after.
+    """
+    
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, group_rate: float = 20, senders: int = 8):
+        self.global_rate = float(global_rate)
+        self.chat_interval = 1.0 / float(chat_rate)
+        # group_rate è espresso in messaggi al minuto
+        self.group_interval = 60.0 / float(group_rate)
+        self._tokens = self.global_rate
+        self._tokens_updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chats: Dict[str, deque] = {}
+        self._next_allowed: Dict[str, float] = {}
+        self._ready = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="telegram-send")
+        self._thread = threading.Thread(target=self._run, name="telegram-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def submit(self, chat_id: str, send: Callable[[], Dict[str, Any]]) -> Future:
+        """
+        Accoda un invio per la chat.
+        
+        send esegue la chiamata all'API e restituisce la risposta JSON; il Future
+        restituito si completa con quella risposta (o con l'eccezione sollevata).
+        """
+        chat_id = str(chat_id)
+        future = Future()
+        with self._condition:
+            jobs = self._chats.get(chat_id)
+            if jobs is None:
+                jobs = self._chats[chat_id] = deque()
+                self._schedule(chat_id, self._next_allowed.get(chat_id, 0.0))
+            jobs.append((send, future))
+            self._condition.notify()
+        return future
+    
+    def _schedule(self, chat_id: str, ready_at: float):
+        heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+    
+    def _take_global_token(self, now: float) -> float:
+        """Consuma un token globale; se non disponibile restituisce l'attesa necessaria"""
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.global_rate, self._tokens + (now - self._tokens_updated) * self.global_rate)
+        self._tokens_updated = now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.global_rate
+        self._tokens -= 1
+        return 0.0
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if self._ready and self._ready[0][0] <= now:
+                        wait = self._take_global_token(now)
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = self._ready[0][0] - now if self._ready else None
+                    self._condition.wait(timeout=wait)
+                _, _, chat_id = heapq.heappop(self._ready)
+                send, future = self._chats[chat_id].popleft()
+                interval = self.group_interval if chat_id.startswith(("-", "@")) else self.chat_interval
+                self._next_allowed[chat_id] = now + interval
+            # La chat resta fuori dalla coda finché l'invio non è terminato: ordine garantito
+            self._executor.submit(self._deliver, chat_id, send, future)
+    
+    def _deliver(self, chat_id: str, send: Callable[[], Dict[str, Any]], future: Future):
+        try:
+            result = send()
+        except Exception as e:
+            result = None
+            future.set_exception(e)
+        
+        with self._condition:
+            retry_after = None
+            if result is not None:
+                if result.get("error_code") == 429:
+                    retry_after = float((result.get("parameters") or {}).get("retry_after", 1))
+                else:
+                    future.set_result(result)
+            jobs = self._chats[chat_id]
+            if retry_after is not None:
+                logger.warning(f"⏳ Limite Telegram raggiunto, nuovo tentativo tra {retry_after:g}s (chat {chat_id})")
+                resume_at = time.monotonic() + retry_after
+                self._paused_until = max(self._paused_until, resume_at)
+                self._next_allowed[chat_id] = resume_at
+                jobs.appendleft((send, future))
+            if jobs:
+                self._schedule(chat_id, self._next_allowed[chat_id])
+            else:
+                del self._chats[chat_id]
+            self._condition.notify()
+
+
+_schedulers: Dict[str, SendScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(bot_token: str, **limits) -> SendScheduler:
+    """Scheduler condiviso del bot; i limiti valgono alla prima creazione"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(bot_token)
+        if scheduler is None:
+            scheduler = _schedulers[bot_token] = SendScheduler(**limits)
+        return scheduler
+
 class TelegramState(BaseState):
     state_type = "telegram-bot"
     
@@ -21,10 +450,13 @@ class TelegramState(BaseState):
     send_telegram:
       state_type: telegram-bot
       bot_token: "{TELEGRAM_BOT_TOKEN}"
-      chat_id: "{TELEGRAM_CHAT_ID}"
-      message: "Testo del messaggio"
+      chat_id: "{TELEGRAM_CHAT_ID}"  # o una lista / una variabile con più chat_id
+      message: "Testo del messaggio"  # didascalia se si invia un file
+      photo: "/path/immagine.jpg"  # opzionale: photo, document o voice (percorso, URL o file_id)
       parse_mode: "HTML"  # opzionale: HTML, Markdown
       disable_notification: false  # opzionale
+      rate_limit: true  # opzionale, rispetta i limiti di invio di Telegram
+      wait_for_delivery: true  # opzionale, false = non attende l'invio
       transition: next_state
     ```
     """
@@ -37,6 +469,15 @@ class TelegramState(BaseState):
         self.parse_mode = self.state_config.get('parse_mode', 'HTML')
         self.disable_notification = self.state_config.get('disable_notification', False)
         
+        # Coda di invio con limiti di frequenza (condivisa per bot da tutto il processo)
+        self.rate_limit = self.state_config.get('rate_limit', True)
+        self.wait_for_delivery = self.state_config.get('wait_for_delivery', True)
+        self.rate_limits = {
+            'global_rate': self.state_config.get('rate_limit_global', 30),
+            'chat_rate': self.state_config.get('rate_limit_chat', 1),
+            'group_rate': self.state_config.get('rate_limit_group', 20)
+        }
+        
     def execute(self, variables: Dict[str, Any]) -> str:
         """
         Invia il messaggio Telegram
@@ -50,28 +491,46 @@ class TelegramState(BaseState):
         try:
             # Risolvi placeholder nelle variabili
             resolved_bot_token = str(self.bot_token).format(**variables)
-            resolved_chat_id = str(self.chat_id).format(**variables)
-            resolved_message = str(self.message).format(**variables)
+            resolved_message = str(self.message or '').format(**variables)
+            media = self._resolve_media(variables)
+            content = self._prepare_content(resolved_message, media)
             
-            # Costruisci l'URL dell'API Telegram
-            url = f"https://api.telegram.org/bot{resolved_bot_token}/sendMessage"
+            # Più destinatari: invio in parallelo nei limiti di frequenza
+            recipients = self._resolve_recipients(variables)
+            if recipients is not None:
+                return self._broadcast(resolved_bot_token, recipients, content, variables)
             
-            # Prepara il payload
-            payload = {
-                'chat_id': resolved_chat_id,
-                'text': resolved_message,
-                'parse_mode': self.parse_mode,
-                'disable_notification': self.disable_notification
-            }
+            resolved_chat_id = str(self.chat_id).format(**variables)
+            calls = self._build_calls(resolved_bot_token, resolved_chat_id, content)
             
             logger.info(f"📱 Invio messaggio Telegram a chat_id: {resolved_chat_id}")
             
-            # Invia la richiesta
-            response = requests.post(url, json=payload, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
+            if not self.rate_limit:
+                results = []
+                for send in calls:
+                    results.append(send())
+                    if not results[-1].get('ok'):
+                        break
+            else:
+                scheduler = get_scheduler(resolved_bot_token, **self.rate_limits)
+                # Le parti di un messaggio lungo restano in ordine nella coda della chat
+                deliveries = [scheduler.submit(resolved_chat_id, send) for send in calls]
+                if not self.wait_for_delivery:
+                    # Invio in background: l'esito è disponibile nel Future 'delivery'
+                    for delivery in deliveries:
+                        delivery.add_done_callback(self._log_delivery)
+                    if self.state_config.get('output'):
+                        variables[self.state_config['output']] = {
+                            'success': True,
+                            'queued': True,
+                            'chat_id': resolved_chat_id,
+                            'delivery': deliveries[0],
+                            'deliveries': deliveries
+                        }
+                    return self.state_config.get('success_transition', self.state_config.get('transition'))
+                results = [delivery.result() for delivery in deliveries]
             
+            result = next((result for result in results if not result.get('ok')), results[0])
             if result.get('ok'):
                 message_id = result['result']['message_id']
                 logger.info(f"✅ Messaggio inviato con successo (ID: {message_id})")
@@ -81,6 +540,7 @@ class TelegramState(BaseState):
                     variables[self.state_config['output']] = {
                         'success': True,
                         'message_id': message_id,
+                        'message_ids': [result['result']['message_id'] for result in results],
                         'chat_id': resolved_chat_id,
                         'timestamp': result['result']['date']
                     }
@@ -110,12 +570,217 @@ class TelegramState(BaseState):
             logger.error(f"❌ Errore inaspettato: {e}")
             return self.state_config.get('error_transition', 'error')
     
+    def _message_payload(self, chat_id: str, text: str) -> Dict[str, Any]:
+        return {
+            'chat_id': chat_id,
+            'text': text,
+            'parse_mode': self.parse_mode,
+            'disable_notification': self.disable_notification
+        }
+    
+    def _resolve_media(self, variables: Dict[str, Any]) -> Optional[tuple]:
+        """Restituisce (campo, percorso/URL/file_id) del file da inviare, se configurato"""
+        for field in MEDIA_METHODS:
+            source = self.state_config.get(field)
+            if source:
+                return field, str(source).format(**variables)
+        return None
+    
+    def _prepare_content(self, text: str, media: Optional[tuple]) -> Dict[str, Any]:
+        """
+        Divide il testo in parti inviabili.
+        
+        Con un file il testo diventa la didascalia se rientra nel limite di 1024 caratteri,
+        altrimenti viene inviato subito dopo il file come messaggi separati.
+        """
+        caption = None
+        if media and text.strip() and text_length(text) <= CAPTION_LIMIT:
+            caption, text = text, ''
+        chunks = split_message(text, self.parse_mode)
+        if len(chunks) > 1:
+            logger.info(f"✂️ Messaggio diviso in {len(chunks)} parti")
+        return {'media': media, 'caption': caption, 'chunks': chunks}
+    
+    def _build_calls(self, bot_token: str, chat_id: str, content: Dict[str, Any]) -> List[Callable[[], Dict[str, Any]]]:
+        """Chiamate all'API necessarie per consegnare il contenuto a una chat, in ordine"""
+        calls = []
+        if content['media']:
+            calls.append(lambda: self._send_media(bot_token, chat_id, content['media'], content['caption']))
+        for chunk in content['chunks']:
+            payload = self._message_payload(chat_id, chunk)
+            calls.append(lambda payload=payload: self._call_api(bot_token, 'sendMessage', payload))
+        return calls
+    
+    def _send_media(self, bot_token: str, chat_id: str, media: tuple, caption: Optional[str]) -> Dict[str, Any]:
+        """
+        Invia un file: i file locali vengono caricati una sola volta, poi si usa il file_id.
+        
+        Il caricamento è protetto da un lock per file, così più invii contemporanei dello
+        stesso file (ad esempio un broadcast) attendono il primo e riusano il suo file_id.
+        """
+        field, source = media
+        method = MEDIA_METHODS[field]
+        payload = {'chat_id': chat_id, 'disable_notification': self.disable_notification}
+        if caption:
+            payload['caption'] = caption
+            payload['parse_mode'] = self.parse_mode
+        
+        # URL e file_id vengono passati direttamente a Telegram
+        if not os.path.isfile(source):
+            return self._call_api(bot_token, method, dict(payload, **{field: source}))
+        
+        key = _file_key(bot_token, method, source)
+        file_id = _get_file_id(key)
+        if file_id is None:
+            with _file_lock(key):
+                file_id = _get_file_id(key)
+                if file_id is None:
+                    logger.info(f"📤 Caricamento file {os.path.basename(source)}")
+                    result = self._upload(bot_token, method, payload, field, source)
+                    file_id = _result_file_id(result, field) if result.get('ok') else None
+                    if file_id:
+                        _store_file_id(key, file_id)
+                    return result
+        
+        result = self._call_api(bot_token, method, dict(payload, **{field: file_id}))
+        description = str(result.get('description', '')).lower()
+        if not result.get('ok') and result.get('error_code') == 400 and any(error in description for error in FILE_ID_ERRORS):
+            # file_id non più valido: si carica di nuovo il file
+            _store_file_id(key, None)
+            return self._send_media(bot_token, chat_id, media, caption)
+        return result
+    
+    def _resolve_recipients(self, variables: Dict[str, Any]) -> Optional[List[str]]:
+        """
+        Restituisce la lista dei destinatari se chat_id ne indica più di uno, altrimenti None.
+        
+        chat_id può essere una lista nella configurazione oppure il riferimento a una
+        variabile ("{subscribers}") che contiene una lista o un altro iterabile.
+        """
+        chat_ids = self.chat_id
+        if isinstance(chat_ids, str):
+            match = re.fullmatch(r'\{(\w+)\}', chat_ids.strip())
+            if not match:
+                return None
+            chat_ids = variables.get(match.group(1))
+            if chat_ids is None or isinstance(chat_ids, (str, bytes, int, dict)):
+                return None
+        if not isinstance(chat_ids, (list, tuple, set)) and not hasattr(chat_ids, '__iter__'):
+            return None
+        
+        recipients = []
+        seen = set()
+        for chat_id in chat_ids:
+            chat_id = str(chat_id).format(**variables)
+            # Ogni destinatario riceve il messaggio una sola volta
+            if chat_id and chat_id not in seen:
+                seen.add(chat_id)
+                recipients.append(chat_id)
+        return recipients
+    
+    def _broadcast(self, bot_token: str, recipients: List[str], content: Dict[str, Any], variables: Dict[str, Any]) -> str:
+        """Invia il messaggio a tutti i destinatari tramite lo scheduler e raccoglie l'esito"""
+        logger.info(f"📣 Invio messaggio Telegram a {len(recipients)} destinatari")
+        scheduler = get_scheduler(bot_token, **self.rate_limits)
+        deliveries = []
+        for chat_id in recipients:
+            calls = self._build_calls(bot_token, chat_id, content)
+            deliveries.append((chat_id, [scheduler.submit(chat_id, send) for send in calls]))
+        
+        output_key = self.state_config.get('output')
+        if not self.wait_for_delivery:
+            if output_key:
+                variables[output_key] = {
+                    'success': True,
+                    'queued': True,
+                    'total': len(recipients),
+                    'deliveries': dict(deliveries)
+                }
+            return self.state_config.get('success_transition', self.state_config.get('transition'))
+        
+        results = []
+        for chat_id, chat_deliveries in deliveries:
+            try:
+                chat_results = [delivery.result() for delivery in chat_deliveries]
+            except Exception as e:
+                results.append({'chat_id': chat_id, 'ok': False, 'message_id': None, 'error': str(e)})
+                continue
+            # Il primo errore tra le parti del messaggio, altrimenti la prima parte
+            result = next((result for result in chat_results if not result.get('ok')), chat_results[0])
+            if result.get('ok'):
+                results.append({'chat_id': chat_id, 'ok': True, 'message_id': result['result']['message_id'], 'error': None})
+            else:
+                results.append({'chat_id': chat_id, 'ok': False, 'message_id': None, 'error': result.get('description', 'Errore sconosciuto')})
+        
+        sent = sum(1 for result in results if result['ok'])
+        failed = len(results) - sent
+        logger.info(f"📣 Invio completato: {sent} inviati, {failed} falliti")
+        
+        # Il broadcast riesce se almeno un destinatario ha ricevuto il messaggio
+        success = sent > 0 or not results
+        if output_key:
+            variables[output_key] = {
+                'success': success,
+                'total': len(results),
+                'sent': sent,
+                'failed': failed,
+                'results': results
+            }
+        if success:
+            return self.state_config.get('success_transition', self.state_config.get('transition'))
+        return self.state_config.get('error_transition', 'error')
+    
+    @staticmethod
+    def _call_api(bot_token: str, method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Chiama un metodo della Bot API e restituisce la risposta JSON"""
+        url = f"https://api.telegram.org/bot{bot_token}/{method}"
+        # Nessun retry: dopo un 5xx il messaggio potrebbe essere già stato consegnato,
+        # i 429 sono gestiti dallo scheduler con retry_after
+        response = http_client.post(url, json=payload, timeout=30, retry_statuses=())
+        return TelegramState._parse_response(response)
+    
+    @staticmethod
+    def _upload(bot_token: str, method: str, payload: Dict[str, Any], field: str, path: str) -> Dict[str, Any]:
+        """Carica un file in streaming come multipart/form-data"""
+        url = f"https://api.telegram.org/bot{bot_token}/{method}"
+        body = MultipartFile(payload, field, path)
+        try:
+            # Il corpo viene consumato durante l'invio: niente retry automatici
+            response = http_client.post(url, data=body, headers={'Content-Type': body.content_type},
+                                        timeout=UPLOAD_TIMEOUT, retries=0)
+        finally:
+            body.close()
+        return TelegramState._parse_response(response)
+    
+    @staticmethod
+    def _parse_response(response: requests.Response) -> Dict[str, Any]:
+        # Le risposte di errore della Bot API (400, 403, 429) contengono la descrizione in JSON
+        if response.status_code >= 500 or 'json' not in response.headers.get('Content-Type', ''):
+            response.raise_for_status()
+        return response.json()
+    
+    @staticmethod
+    def _log_delivery(delivery: Future):
+        """Registra l'esito di un invio non bloccante"""
+        try:
+            result = delivery.result()
+        except Exception as e:
+            logger.error(f"❌ Errore nell'invio Telegram in background: {e}")
+            return
+        if result.get('ok'):
+            logger.info(f"✅ Messaggio inviato con successo (ID: {result['result']['message_id']})")
+        else:
+            logger.error(f"❌ Errore Telegram: {result.get('description', 'Errore sconosciuto')}")
+    
     def validate_config(self) -> bool:
         """
         Valida la configurazione dello stato
         """
-        required_fields = ['bot_token', 'chat_id', 'message']
+        required_fields = ['bot_token', 'chat_id']
         missing_fields = [field for field in required_fields if not self.state_config.get(field)]
+        # Serve un testo o un file da inviare
+        if not self.state_config.get('message') and not any(self.state_config.get(field) for field in MEDIA_METHODS):
+            missing_fields.append('message')
         
         if missing_fields:
             raise ValueError(f"Campi mancanti in telegram state: {', '.join(missing_fields)}")
@@ -4,24 +4,308 @@ Ascolta messaggi in arrivo da bot Telegram e triggera workflow automaticamente
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import logging
 import threading
 import os
 import uuid
+import hmac
+import io
+import json
+import re
+import queue
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Callable
 from yaml import safe_load
 from flow.flow import FlowDiagram
 from flow.listeners.base_listener import BaseListener
 
 logger = logging.getLogger(__name__)
 
+# Dimensione dei blocchi per il download dei file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Intervallo minimo in secondi tra due pulizie della cartella dei vocali
+VOICE_CLEANUP_INTERVAL = 600
+
+
+class UpdateDispatcher:
+    """
+    Pool limitato di worker per processare gli update in parallelo.
+    
+    Ogni chat viene assegnata sempre allo stesso worker (hash del chat_id), quindi i
+    messaggi di una chat restano in ordine mentre chat diverse procedono in parallelo.
+    Le code hanno dimensione massima: quando sono piene submit attende, rallentando
+    la ricezione invece di accumulare update in memoria.
+    """
+    
+    def __init__(self, handler: Callable[[Dict[str, Any]], None], workers: int = 1, max_queue_size: int = 1000):
+        self.handler = handler
+        workers = max(1, int(workers))
+        per_worker = max(1, int(max_queue_size) // workers)
+        self._queues = [queue.Queue(maxsize=per_worker) for _ in range(workers)]
+        self._threads = []
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._worker, args=(work_queue,), name=f"telegram-worker-{index}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, chat_id: str, update: Dict[str, Any]):
+        """Accoda l'update sul worker della chat; ritorna quando l'update è in coda"""
+        shard = zlib.crc32(str(chat_id).encode("utf-8")) % len(self._queues)
+        self._queues[shard].put(update)
+    
+    def pending(self) -> int:
+        """Numero di update in coda non ancora presi in carico"""
+        return sum(work_queue.qsize() for work_queue in self._queues)
+    
+    def _worker(self, work_queue: "queue.Queue"):
+        while True:
+            update = work_queue.get()
+            if update is None:
+                break
+            try:
+                self.handler(update)
+            except Exception as e:
+                logger.error(f"❌ Errore nel worker Telegram: {e}")
+    
+    def stop(self):
+        """Processa gli update già in coda e ferma i worker"""
+        for work_queue in self._queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+# Modelli di trascrizione locali già caricati, condivisi da tutto il processo
+_whisper_models: Dict[str, Any] = {}
+# Un modello non può trascrivere da più thread insieme: la kv-cache di transcribe usa hook
+# registrati sui moduli condivisi del decoder
+_whisper_locks: Dict[str, threading.Lock] = {}
+_whisper_models_lock = threading.Lock()
+
+
+def get_whisper_model(model_name: str):
+    """Carica il modello Whisper al primo utilizzo e lo riusa per i messaggi successivi"""
+    with _whisper_models_lock:
+        model = _whisper_models.get(model_name)
+        if model is None:
+            import whisper
+            
+            logger.info(f"🎯 Caricamento modello Whisper '{model_name}'...")
+            model = whisper.load_model(model_name)
+            _whisper_models[model_name] = model
+            _whisper_locks[model_name] = threading.Lock()
+        return model
+
+
+def transcribe_with_whisper(file_path: str, model_name: str, language: str) -> str:
+    """
+    Trascrive un file con il modello Whisper residente.
+    
+    Funzione di modulo per poter essere eseguita anche nei processi del pool di
+    trascrizione: ogni processo carica il modello una sola volta. Nello stesso processo
+    le trascrizioni con lo stesso modello vengono eseguite una alla volta.
+    """
+    model = get_whisper_model(model_name)
+    with _whisper_locks[model_name]:
+        result = model.transcribe(file_path, language=language or None)
+    return result["text"].strip()
+
+
+class OffsetCheckpoint:
+    """
+    Salva su file l'ultimo update_id processato, per riprendere dopo un riavvio.
+    
+    Il file viene scritto in modo atomico (file temporaneo, fsync e rename): dopo un
+    crash contiene sempre il valore precedente o quello nuovo, mai un file parziale.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+    
+    def load(self) -> Optional[int]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return int(json.load(f)["last_update_id"])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"⚠️ File di stato non valido {self.path}: {e}")
+            return None
+    
+    def save(self, update_id: int):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"last_update_id": update_id, "updated_at": time.time()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+
+class MediaGroupBuffer:
+    """
+    Raggruppa gli update di un album (stesso media_group_id).
+    
+    Telegram invia ogni elemento dell'album come update separato: gli update vengono
+    trattenuti finché per window secondi non ne arrivano altri dello stesso gruppo (o
+    l'album raggiunge MAX_ITEMS elementi), poi on_flush riceve la lista completa. Il
+    numero di gruppi in attesa è limitato da max_groups: oltre il limite il gruppo più
+    vecchio viene consegnato subito.
+    """
+    
+    # Numero massimo di elementi in un album Telegram
+    MAX_ITEMS = 10
+    
+    def __init__(self, on_flush: Callable[[List[Dict[str, Any]]], None], window: float = 1.0, max_groups: int = 100):
+        self.on_flush = on_flush
+        self.window = window
+        self.max_groups = max(1, int(max_groups))
+        self._groups = OrderedDict()
+        self._ready = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="telegram-media-groups")
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def add(self, update: Dict[str, Any]) -> bool:
+        """Trattiene l'update nel suo gruppo; False se il buffer è chiuso"""
+        group_id = update["message"]["media_group_id"]
+        with self._condition:
+            if self._closed:
+                return False
+            if group_id not in self._groups and len(self._groups) >= self.max_groups:
+                _, (_, oldest) = self._groups.popitem(last=False)
+                self._ready.append(oldest)
+            _, updates = self._groups.pop(group_id, (None, []))
+            updates.append(update)
+            if len(updates) >= self.MAX_ITEMS:
+                self._ready.append(updates)
+            else:
+                self._groups[group_id] = (time.monotonic(), updates)
+            self._condition.notify()
+        return True
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._ready and not self._closed:
+                    self._condition.wait(timeout=self.window / 2)
+                now = time.monotonic()
+                # I gruppi sono in ordine di ultimo aggiornamento: i primi sono i più vecchi
+                while self._groups:
+                    group_id, (last_seen, updates) = next(iter(self._groups.items()))
+                    if not self._closed and now - last_seen < self.window:
+                        break
+                    del self._groups[group_id]
+                    self._ready.append(updates)
+                ready, self._ready = self._ready, []
+                closed = self._closed
+            for updates in ready:
+                try:
+                    self.on_flush(updates)
+                except Exception as e:
+                    logger.error(f"❌ Errore nella consegna dell'album: {e}")
+            if closed:
+                break
+    
+    def stop(self):
+        """Consegna i gruppi in attesa; gli update successivi non vengono più raggruppati"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+
+# Tipi di messaggio riconosciuti, nell'ordine in cui vengono verificati
+MESSAGE_TYPES = ("photo", "document", "audio", "video", "voice", "sticker", "location", "contact")
+
+
+def detect_message_type(message: Dict[str, Any]) -> str:
+    """Determina il tipo di messaggio senza scaricare nulla"""
+    for message_type in MESSAGE_TYPES:
+        if message.get(message_type):
+            return message_type
+    return "text"
+
+
+def parse_command(text: str) -> str:
+    """Restituisce il comando all'inizio del testo ("/start@MioBot arg" -> "/start"), o stringa vuota"""
+    if not text.startswith("/"):
+        return ""
+    return text.split(maxsplit=1)[0].split("@", 1)[0].lower()
+
+
+class MessageRoute:
+    """
+    Regola di instradamento: associa i messaggi a un file di configurazione del flusso.
+    
+    Tutti i criteri indicati devono essere soddisfatti (comando, regex sul testo o
+    sulla caption, tipo di chat, tipo di messaggio); i criteri assenti non filtrano.
+    I pattern vengono compilati una sola volta alla creazione della regola.
+    """
+    
+    def __init__(self, route: Dict[str, Any], index: int):
+        self.name = route.get("name", f"route{index + 1}")
+        self.config_file = route.get("config_file")
+        commands = route.get("command", [])
+        if isinstance(commands, str):
+            commands = [commands]
+        self.commands = frozenset("/" + command.lstrip("/").lower() for command in commands)
+        self.regex = re.compile(route["regex"]) if route.get("regex") else None
+        self.chat_types = frozenset(route.get("chat_types", []))
+        self.message_types = frozenset(route.get("message_types", []))
+    
+    def matches(self, text: str, command: str, chat_type: str, message_type: str) -> bool:
+        if self.message_types and message_type not in self.message_types:
+            return False
+        if self.chat_types and chat_type not in self.chat_types:
+            return False
+        if self.commands and command not in self.commands:
+            return False
+        if self.regex and not self.regex.search(text):
+            return False
+        return True
+
+
+def media_item(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Descrive un elemento di un album per la variabile telegram_media_items"""
+    message_type = detect_message_type(message)
+    media = message.get(message_type) or {}
+    # Per le foto Telegram invia più dimensioni: si usa la più grande (l'ultima)
+    if isinstance(media, list):
+        media = media[-1] if media else {}
+    return {
+        "type": message_type,
+        "message_id": str(message.get("message_id", "")),
+        "file_id": media.get("file_id", ""),
+        "file_unique_id": media.get("file_unique_id", ""),
+        "file_name": media.get("file_name", ""),
+        "file_size": media.get("file_size", 0),
+        "mime_type": media.get("mime_type", ""),
+        "caption": message.get("caption", "")
+    }
+
+
+def update_chat_id(update: Dict[str, Any]) -> str:
+    """Restituisce il chat_id dell'update, usato per mantenere l'ordine per chat"""
+    message = update.get("message") or {}
+    return str(message.get("chat", {}).get("id", ""))
+
+
 class TelegramListener(BaseListener):
     """
     Listener per messaggi Telegram in arrivo.
     
-    Utilizza long polling per ascoltare messaggi e triggerare workflow automaticamente.
+    Utilizza long polling (o, in alternativa, un webhook) per ascoltare messaggi e
+    triggerare workflow automaticamente.
     Supporta filtraggio per chat_id, tipi di messaggio e configurazioni avanzate.
     """
     
@@ -30,6 +314,18 @@ class TelegramListener(BaseListener):
     def __init__(self, event_config: Dict[str, Any], global_context: Optional[Dict[str, Any]] = None):
         super().__init__(event_config, global_context)
         
+        # Più bot nello stesso listener: ognuno è un TelegramListener con la propria
+        # configurazione (i parametri comuni vengono ereditati dal listener principale)
+        self._bots = [
+            TelegramListener(self._bot_config(event_config, bot, index), global_context)
+            for index, bot in enumerate(event_config.get("bots", []))
+        ]
+        if self._bots:
+            self._share_webhook_servers(self._bots)
+            self._running = False
+            logger.info(f"🤖 Telegram Listener inizializzato con {len(self._bots)} bot")
+            return
+        
         # Configurazione del bot
         bot_token_raw = event_config.get("bot_token")
         if not bot_token_raw:
@@ -41,25 +337,77 @@ class TelegramListener(BaseListener):
         else:
             self.bot_token = bot_token_raw
         
-        # Configurazioni di filtraggio
+        self.bot_name = event_config.get("name", "")
+        
+        # Tabella di instradamento: il primo route che corrisponde sceglie il flusso
+        self.routes = [MessageRoute(route, index) for index, route in enumerate(event_config.get("routes", []))]
+        
+        # Configurazioni di filtraggio (con i route, di default ogni tipo è ammesso)
         self.allowed_chat_ids = event_config.get("allowed_chat_ids", [])
-        self.message_types = event_config.get("message_types", ["text"])
+        default_types = ["text", *MESSAGE_TYPES] if self.routes else ["text"]
+        self.message_types = event_config.get("message_types", default_types)
         
         # Configurazioni di polling
         self.polling_interval = event_config.get("polling_interval", 2)
         self.timeout = event_config.get("timeout", 30)
         self.ignore_old_messages = event_config.get("ignore_old_messages", True)
         
+        # Raggruppamento degli album: finestra in secondi (0 = disabilitato)
+        self.media_group_window = event_config.get("media_group_window", 0)
+        self.max_media_groups = event_config.get("max_media_groups", 100)
+        
+        # Elaborazione parallela: un worker per gruppo di chat, ordine garantito per chat
+        self.workers = event_config.get("workers", 1)
+        self.max_queue_size = event_config.get("max_queue_size", 1000)
+        # Update ricevuti e non ancora processati al massimo (getUpdates ne restituisce al più 100)
+        self.max_in_flight = min(max(1, int(event_config.get("max_in_flight", 100))), 100)
+        
+        # Modalità di ricezione: long polling (default) o webhook
+        self.mode = event_config.get("mode", "polling")
+        if self.mode not in ("polling", "webhook"):
+            raise ValueError(f"mode non valido: {self.mode} (valori ammessi: polling, webhook)")
+        
+        # Configurazioni webhook
+        self.webhook_url = event_config.get("webhook_url", "")
+        secret_token = event_config.get("secret_token", "")
+        if global_context:
+            self.webhook_url = self.format_recursive(self.webhook_url, global_context)
+            secret_token = self.format_recursive(secret_token, global_context)
+        self.webhook_host = event_config.get("webhook_host", "0.0.0.0")
+        self.webhook_port = event_config.get("webhook_port", 8443)
+        self.webhook_path = event_config.get("webhook_path", "/telegram")
+        self.max_connections = event_config.get("max_connections", 40)
+        self.webhook_ssl_cert = event_config.get("webhook_ssl_cert")
+        self.webhook_ssl_key = event_config.get("webhook_ssl_key")
+        # Se non configurato viene generato un secret casuale ad ogni avvio
+        self.secret_token = secret_token or uuid.uuid4().hex
+        
+        if self.mode == "webhook" and not self.webhook_url:
+            raise ValueError("webhook_url è obbligatorio in modalità webhook")
+        
         # Configurazioni per messaggi vocali (opzionali)
         self.download_voice = event_config.get("download_voice", False)  # Default: disabilitato
         self.voice_download_path = event_config.get("voice_download_path", "workspace")
         self.transcribe_voice = event_config.get("transcribe_voice", False)  # Default: disabilitato
+        self.voice_retention_hours = event_config.get("voice_retention_hours", 24)  # 0 = conserva per sempre
+        self._last_cleanup = 0.0
+        self._cleanup_lock = threading.Lock()
         
         # Crea la cartella workspace solo se download è abilitato
         if self.download_voice:
             os.makedirs(self.voice_download_path, exist_ok=True)
             logger.info(f"📁 Download vocali abilitato in: {self.voice_download_path}")
         
+        # Configurazioni di trascrizione
+        self.transcription_engine = event_config.get("transcription_engine", "auto")
+        if self.transcription_engine not in ("auto", "google", "whisper"):
+            raise ValueError(f"transcription_engine non valido: {self.transcription_engine} (valori ammessi: auto, google, whisper)")
+        self.transcription_model = event_config.get("transcription_model", "base")
+        self.transcription_language = event_config.get("transcription_language", "it-IT")
+        self.transcription_processes = event_config.get("transcription_processes", 0)
+        self._transcription_pool = None
+        self._transcription_pool_lock = threading.Lock()
+        
         if self.transcribe_voice:
             logger.info("🎯 Trascrizione vocali abilitata")
         
@@ -67,15 +415,87 @@ class TelegramListener(BaseListener):
         self._running = False
         self._thread = None
         self._last_update_id = 0
-        self._api_base_url = f"https://api.telegram.org/bot{self.bot_token}"
+        # update_id fino al quale tutti gli update sono stati processati (vedi _complete_update)
+        self._committed_update_id = 0
+        self._pending_update_ids = set()
+        # update_id -> Event impostato quando l'update è stato processato (vedi _complete_update)
+        self._update_events = {}
+        self._offset_lock = threading.Lock()
+        self._offset_changed = threading.Condition(self._offset_lock)
+        state_file = event_config.get("state_file")
+        self._checkpoint = OffsetCheckpoint(state_file) if state_file else None
+        self._resumed = False
+        self._server = None
+        # Bot che condividono il server webhook di questo (stessa porta) e bot proprietario
+        self._webhook_bots = []
+        self._webhook_owner = None
+        self._dispatcher = None
+        self._media_groups = None
+        self._session = self._create_session()
+        # api_url permette di usare un Bot API server locale al posto di api.telegram.org
+        api_url = event_config.get("api_url", "https://api.telegram.org").rstrip("/")
+        self._api_base_url = f"{api_url}/bot{self.bot_token}"
+        self._file_base_url = f"{api_url}/file/bot{self.bot_token}"
         
         logger.info(f"🤖 Telegram Listener inizializzato per bot token: ...{self.bot_token[-10:]}")
     
+    @staticmethod
+    def _bot_config(event_config: Dict[str, Any], bot: Dict[str, Any], index: int) -> Dict[str, Any]:
+        """Configurazione di un singolo bot: parametri comuni più quelli specifici del bot"""
+        bot_config = {key: value for key, value in event_config.items() if key != "bots"}
+        bot_config.update(bot)
+        bot_config.setdefault("name", f"bot{index + 1}")
+        # Un file di stato ereditato viene separato per bot
+        if "state_file" in event_config and "state_file" not in bot:
+            root, ext = os.path.splitext(event_config["state_file"])
+            bot_config["state_file"] = f"{root}.{bot_config['name']}{ext}"
+        # Così anche il percorso webhook ereditato: i bot condividono il server sulla stessa porta
+        if "webhook_path" not in bot:
+            webhook_path = event_config.get("webhook_path", "/telegram").rstrip("/")
+            bot_config["webhook_path"] = f"{webhook_path}/{bot_config['name']}"
+        return bot_config
+    
+    @staticmethod
+    def _share_webhook_servers(bots: List["TelegramListener"]):
+        """
+        Assegna un solo server webhook ai bot in ascolto sullo stesso host e porta.
+        
+        Il primo bot del gruppo crea il server e vi registra i percorsi degli altri,
+        che devono quindi essere distinti e usare lo stesso certificato TLS.
+        """
+        owners = {}
+        for bot in bots:
+            if bot.mode != "webhook":
+                continue
+            owner = owners.setdefault((bot.webhook_host, bot.webhook_port), bot)
+            if owner is bot:
+                continue
+            if any(other.webhook_path == bot.webhook_path for other in [owner, *owner._webhook_bots]):
+                raise ValueError(f"webhook_path duplicato sulla porta {bot.webhook_port}: {bot.webhook_path}")
+            if (bot.webhook_ssl_cert, bot.webhook_ssl_key) != (owner.webhook_ssl_cert, owner.webhook_ssl_key):
+                raise ValueError(f"I bot sulla porta {bot.webhook_port} devono usare lo stesso certificato TLS")
+            owner._webhook_bots.append(bot)
+            bot._webhook_owner = owner
+    
+    def _create_session(self) -> requests.Session:
+        """
+        Crea la sessione HTTP condivisa da polling, getFile e download.
+        
+        Le connessioni verso la Bot API restano aperte (keep-alive) e vengono
+        riutilizzate, evitando un nuovo handshake TCP+TLS ad ogni richiesta; il pool
+        è dimensionato sui worker che scaricano file in parallelo.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(10, int(self.workers) + 2))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    
     def setup(self):
         """Setup del listener - verifica la connessione al bot"""
         try:
             # Test della connessione con getMe
-            response = requests.get(f"{self._api_base_url}/getMe", timeout=10)
+            response = self._session.get(f"{self._api_base_url}/getMe", timeout=10)
             response.raise_for_status()
             
             bot_info = response.json()
@@ -83,8 +503,16 @@ class TelegramListener(BaseListener):
                 bot_data = bot_info["result"]
                 logger.info(f"✅ Connessione al bot Telegram verificata: @{bot_data.get('username', 'unknown')}")
                 
+                # Riprendi dall'ultimo update processato, se salvato
+                saved_update_id = self._checkpoint.load() if self._checkpoint else None
+                if saved_update_id is not None:
+                    self._last_update_id = self._committed_update_id = saved_update_id
+                    self._resumed = True
+                    logger.info(f"📍 Ripresa dall'update_id salvato: {saved_update_id}")
+                
                 # Se ignoriamo i messaggi vecchi, ottieni l'ultimo update_id
-                if self.ignore_old_messages:
+                # (in modalità webhook il webhook viene registrato con il server avviato)
+                if self.mode != "webhook" and self.ignore_old_messages and not self._resumed:
                     self._get_latest_update_id()
                     
             else:
@@ -101,30 +529,89 @@ class TelegramListener(BaseListener):
         Args:
             config_file: Path del file di configurazione YAML
         """
-        logger.info(f"🚀 Avvio Telegram Listener - polling ogni {self.polling_interval}s")
-        
-        # Setup iniziale
-        self.setup()
-        
-        # Avvia il thread di polling
-        self._running = True
-        self._thread = threading.Thread(target=self._polling_loop, args=(config_file,))
-        self._thread.daemon = True
-        self._thread.start()
+        if self._bots:
+            for bot in self._bots:
+                bot.start(config_file)
+            self._running = True
+        else:
+            self.start(config_file)
         
         try:
-            # Mantieni il thread principale attivo
-            while self._running:
+            # Mantieni il thread principale attivo finché c'è almeno un bot in esecuzione
+            while self._running and (not self._bots or any(bot._running for bot in self._bots)):
                 time.sleep(1)
         except KeyboardInterrupt:
             logger.info("🛑 Interruzione ricevuta, fermando il listener...")
             self.stop()
     
+    def start(self, config_file: str):
+        """Esegue il setup e avvia in background il polling (o il webhook) e i worker"""
+        if self.mode == "webhook":
+            logger.info(f"🚀 Avvio Telegram Listener - webhook su {self.webhook_host}:{self.webhook_port}{self.webhook_path}")
+        else:
+            logger.info(f"🚀 Avvio Telegram Listener - polling ogni {self.polling_interval}s")
+        
+        # Setup iniziale
+        self.setup()
+        
+        # Avvia i worker e il thread di polling o il server webhook
+        self._running = True
+        self._dispatcher = UpdateDispatcher(
+            lambda update: self._handle_update(update, config_file),
+            workers=self.workers,
+            max_queue_size=self.max_queue_size
+        )
+        if self.media_group_window > 0:
+            self._media_groups = MediaGroupBuffer(
+                self._submit_media_group,
+                window=self.media_group_window,
+                max_groups=self.max_media_groups
+            )
+        if self.mode == "webhook":
+            # I bot sulla stessa porta usano il server del primo bot del gruppo
+            if self._webhook_owner is None:
+                self._server = self._create_webhook_server()
+                self._thread = threading.Thread(target=self._server.serve_forever)
+        else:
+            self._thread = threading.Thread(target=self._polling_loop, args=(config_file,))
+        if self._thread:
+            self._thread.daemon = True
+            self._thread.start()
+        
+        if self.mode == "webhook":
+            # Telegram invia gli update appena il webhook è registrato: il server è già in ascolto
+            try:
+                self._set_webhook()
+            except Exception as e:
+                logger.error(f"❌ Errore durante la registrazione del webhook: {e}")
+                self.stop()
+                raise
+    
     def stop(self):
         """Ferma il listener"""
         self._running = False
+        if self._bots:
+            for bot in self._bots:
+                bot.stop()
+            return
+        if self.mode == "webhook":
+            self._delete_webhook()
+        if self._server:
+            self._server.shutdown()
+            self._server = None
         if self._thread and self._thread.is_alive():
             self._thread.join(timeout=5)
+        if self._media_groups:
+            self._media_groups.stop()
+            self._media_groups = None
+        if self._dispatcher:
+            # Processa gli update già in coda, così il file di stato li include
+            self._dispatcher.stop()
+            self._dispatcher = None
+        if self._transcription_pool:
+            self._transcription_pool.shutdown()
+            self._transcription_pool = None
+        self._session.close()
         logger.info("🛑 Telegram Listener fermato")
     
     def _polling_loop(self, config_file: str):
@@ -134,27 +621,37 @@ class TelegramListener(BaseListener):
         
         while self._running:
             try:
+                # Backpressure: non si ricevono nuovi update finché la finestra è piena
+                self._wait_for_window()
+                if not self._running:
+                    break
+                
                 # Ottieni gli aggiornamenti da Telegram
                 updates = self._get_updates()
                 
-                if updates:
-                    logger.debug(f"📨 Ricevuti {len(updates)} aggiornamenti")
+                # Scarta gli update già accodati: restano non confermati finché non sono processati
+                with self._offset_lock:
+                    last_update_id = self._last_update_id
+                new_updates = [update for update in updates if update.get("update_id", 0) > last_update_id]
+                
+                if new_updates:
+                    logger.debug(f"📨 Ricevuti {len(new_updates)} aggiornamenti")
                     
-                    for update in updates:
+                    for update in new_updates:
+                        self._wait_for_window()
                         if not self._running:
                             break
                         
-                        # Processa ogni messaggio
-                        self._process_update(update, config_file)
-                        
-                        # Aggiorna l'ultimo update_id processato
-                        self._last_update_id = max(self._last_update_id, update.get("update_id", 0))
+                        # Accoda il messaggio sul worker della sua chat
+                        self._queue_update(update)
                 
                 # Reset del contatore errori se tutto va bene
                 consecutive_errors = 0
                 
-                # Pausa prima del prossimo polling
-                time.sleep(self.polling_interval)
+                # Pausa prima del prossimo polling solo se non sono arrivati messaggi:
+                # con il long polling la richiesta successiva attende già i nuovi update
+                if not new_updates:
+                    time.sleep(self.polling_interval)
                 
             except Exception as e:
                 consecutive_errors += 1
@@ -171,12 +668,12 @@ class TelegramListener(BaseListener):
     def _get_updates(self) -> List[Dict[str, Any]]:
         """Ottiene gli aggiornamenti da Telegram API"""
         params = {
-            "offset": self._last_update_id + 1,
+            "offset": self._polling_offset(),
             "timeout": self.timeout,
             "limit": 100
         }
         
-        response = requests.get(
+        response = self._session.get(
             f"{self._api_base_url}/getUpdates",
             params=params,
             timeout=self.timeout + 5
@@ -189,16 +686,183 @@ class TelegramListener(BaseListener):
         else:
             raise Exception(f"Errore API Telegram: {result.get('description', 'Unknown error')}")
     
+    def _polling_offset(self) -> int:
+        """
+        Offset per getUpdates: Telegram considera confermati tutti gli update precedenti.
+        
+        L'offset segue l'ultimo update processato (lo stesso salvato nel file di stato):
+        gli update accodati ma non ancora processati restano non confermati e, dopo un
+        crash, Telegram li consegna di nuovo. Finché restano in sospeso getUpdates li
+        restituisce ancora e il polling li scarta.
+        """
+        with self._offset_lock:
+            return self._committed_update_id + 1
+    
+    def _wait_for_window(self):
+        """
+        Attende finché gli update accodati e non ancora processati sono max_in_flight.
+        
+        getUpdates riparte dal primo update non processato e ne restituisce al più 100:
+        oltre questa finestra non porterebbe comunque update nuovi.
+        """
+        with self._offset_changed:
+            while self._running and len(self._pending_update_ids) >= self.max_in_flight:
+                self._offset_changed.wait(1)
+    
+    def _queue_update(self, update: Dict[str, Any]) -> threading.Event:
+        """
+        Accoda l'update sul worker della sua chat e ne tiene traccia fino al completamento.
+        
+        Restituisce un Event impostato quando l'update è stato processato e il file di
+        stato aggiornato.
+        """
+        update_id = update.get("update_id", 0)
+        with self._offset_lock:
+            done = self._update_events.get(update_id)
+            if done is not None:
+                # Già in coda (Telegram lo sta reinviando): si attende lo stesso completamento
+                return done
+            done = self._update_events[update_id] = threading.Event()
+            self._pending_update_ids.add(update_id)
+            self._last_update_id = max(self._last_update_id, update_id)
+        self._dispatcher.submit(update_chat_id(update), update)
+        return done
+    
+    def _handle_update(self, update: Dict[str, Any], config_file: str):
+        """Eseguito dai worker: processa l'update e ne registra il completamento"""
+        message = update.get("message") or {}
+        # Gli elementi di un album vengono completati quando l'album viene processato
+        if self._media_groups and message.get("media_group_id") and "media_group" not in update:
+            if self._media_groups.add(update):
+                return
+        
+        group = update.get("media_group")
+        try:
+            if group:
+                self._process_update(group[0], config_file, group)
+            else:
+                self._process_update(update, config_file)
+        finally:
+            for item in group or [update]:
+                self._complete_update(item.get("update_id", 0))
+    
+    def _submit_media_group(self, updates: List[Dict[str, Any]]):
+        """Accoda l'album completo sul worker della sua chat"""
+        updates.sort(key=lambda item: item["message"].get("message_id", 0))
+        # Il messaggio principale è quello con la caption (di solito il primo)
+        primary = next((item for item in updates if item["message"].get("caption")), updates[0])
+        group = [primary] + [item for item in updates if item is not primary]
+        self._dispatcher.submit(update_chat_id(primary), {"message": primary["message"], "media_group": group})
+    
+    def _complete_update(self, update_id: int):
+        """
+        Aggiorna l'update_id completato e lo salva nel file di stato.
+        
+        Con più worker gli update terminano in ordine sparso: il valore salvato è il più
+        alto per cui tutti gli update precedenti sono stati processati.
+        """
+        with self._offset_lock:
+            self._pending_update_ids.discard(update_id)
+            done = self._update_events.pop(update_id, None)
+            if self._pending_update_ids:
+                committed = min(self._pending_update_ids) - 1
+            else:
+                committed = self._last_update_id
+            if committed > self._committed_update_id:
+                self._committed_update_id = committed
+                if self._checkpoint:
+                    try:
+                        self._checkpoint.save(committed)
+                    except OSError as e:
+                        logger.error(f"❌ Impossibile salvare il file di stato: {e}")
+            self._offset_changed.notify_all()
+        if done is not None:
+            done.set()
+    
+    def _set_webhook(self):
+        """Registra il webhook presso Telegram"""
+        url = f"{self.webhook_url.rstrip('/')}{self.webhook_path}"
+        payload = {
+            "url": url,
+            "secret_token": self.secret_token,
+            "max_connections": self.max_connections,
+            "allowed_updates": ["message"],
+            "drop_pending_updates": self.ignore_old_messages and not self._resumed
+        }
+        response = self._session.post(f"{self._api_base_url}/setWebhook", json=payload, timeout=10)
+        response.raise_for_status()
+        
+        result = response.json()
+        if not result.get("ok"):
+            raise Exception(f"Errore registrazione webhook: {result.get('description', 'Unknown error')}")
+        logger.info(f"🔗 Webhook registrato: {url} (max_connections: {self.max_connections})")
+    
+    def _delete_webhook(self):
+        """Rimuove il webhook, così il bot può tornare a usare il polling"""
+        try:
+            response = self._session.post(f"{self._api_base_url}/deleteWebhook", timeout=10)
+            response.raise_for_status()
+            logger.info("🔗 Webhook rimosso")
+        except Exception as e:
+            logger.warning(f"⚠️ Impossibile rimuovere il webhook: {e}")
+    
+    def _create_webhook_server(self):
+        """Crea il server HTTP che riceve gli update inviati da Telegram a questo bot e ai bot che lo condividono"""
+        from flask import Flask
+        from werkzeug.serving import make_server
+        
+        app = Flask(__name__)
+        for index, bot in enumerate([self, *self._webhook_bots]):
+            app.add_url_rule(bot.webhook_path, f"telegram_webhook_{index}", bot._webhook_view(), methods=['POST'])
+        
+        ssl_context = None
+        if self.webhook_ssl_cert and self.webhook_ssl_key:
+            ssl_context = (self.webhook_ssl_cert, self.webhook_ssl_key)
+        
+        return make_server(self.webhook_host, self.webhook_port, app, threaded=True, ssl_context=ssl_context)
+    
+    def _webhook_view(self):
+        """Vista Flask dell'endpoint webhook di questo bot"""
+        from flask import request, jsonify
+        
+        def telegram_webhook():
+            # Telegram invia il secret configurato con setWebhook in questo header
+            received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(received, self.secret_token):
+                logger.warning(f"🚫 Richiesta webhook con secret token non valido da {request.remote_addr}")
+                return jsonify({"ok": False}), 403
+            
+            # Bot non ancora avviato (server condiviso) o in chiusura: Telegram riproverà
+            if not self._running or not self._dispatcher:
+                return jsonify({"ok": False}), 503
+            
+            update = request.get_json(silent=True)
+            if not isinstance(update, dict):
+                return jsonify({"ok": False}), 400
+            
+            # Telegram considera consegnato l'update solo con la risposta 200 e reinvia gli altri,
+            # anche dopo un riavvio: si risponde dopo che è stato processato e il file di stato
+            # aggiornato, così un crash non lo perde. Gli update possono arrivare in ordine
+            # sparso (max_connections > 1), quindi non si scartano in base all'update_id
+            done = self._queue_update(update)
+            while not done.wait(1):
+                if not self._running:
+                    # In chiusura: senza conferma Telegram lo reinvierà
+                    return jsonify({"ok": False}), 503
+            return jsonify({"ok": True}), 200
+        
+        return telegram_webhook
+    
     def _get_latest_update_id(self):
         """Ottiene l'ultimo update_id per ignorare messaggi vecchi"""
         try:
             params = {"offset": -1, "limit": 1}
-            response = requests.get(f"{self._api_base_url}/getUpdates", params=params, timeout=10)
+            response = self._session.get(f"{self._api_base_url}/getUpdates", params=params, timeout=10)
             response.raise_for_status()
             
             result = response.json()
             if result.get("ok") and result.get("result"):
-                self._last_update_id = result["result"][0].get("update_id", 0)
+                self._last_update_id = self._committed_update_id = result["result"][0].get("update_id", 0)
                 logger.info(f"📍 Ultimo update_id impostato a: {self._last_update_id}")
         except Exception as e:
             logger.warning(f"⚠️ Impossibile ottenere l'ultimo update_id: {e}")
@@ -222,7 +886,7 @@ class TelegramListener(BaseListener):
                 return None
             
             # Ottieni informazioni sul file
-            file_info_response = requests.get(
+            file_info_response = self._session.get(
                 f"{self._api_base_url}/getFile",
                 params={"file_id": file_id},
                 timeout=10
@@ -248,16 +912,27 @@ class TelegramListener(BaseListener):
             filename = f"voice_{timestamp}_{chat_id}_{message_id}_{unique_id}{file_extension}"
             local_path = os.path.join(self.voice_download_path, filename)
             
-            # Scarica il file
-            download_url = f"https://api.telegram.org/file/bot{self.bot_token}/{file_path}"
+            # Scarica il file a blocchi direttamente su disco, senza tenerlo in memoria
+            download_url = f"{self._file_base_url}/{file_path}"
             logger.info(f"🎤 Scaricamento vocale: {filename}")
             
-            download_response = requests.get(download_url, timeout=30)
-            download_response.raise_for_status()
+            temp_path = f"{local_path}.part"
+            written = 0
+            try:
+                with self._session.get(download_url, timeout=30, stream=True) as download_response:
+                    download_response.raise_for_status()
+                    with open(temp_path, 'wb') as f:
+                        for chunk in download_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            written += len(chunk)
+                os.replace(temp_path, local_path)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            file_size = file_size or written
             
-            # Salva il file
-            with open(local_path, 'wb') as f:
-                f.write(download_response.content)
+            self._cleanup_voice_files()
             
             # Informazioni sul file scaricato
             file_info_result = {
@@ -279,6 +954,36 @@ class TelegramListener(BaseListener):
                 "error": str(e)
             }
     
+    def _cleanup_voice_files(self):
+        """Elimina i vocali scaricati più vecchi di voice_retention_hours (al massimo ogni 10 minuti)"""
+        if self.voice_retention_hours <= 0:
+            return
+        now = time.time()
+        with self._cleanup_lock:
+            if now - self._last_cleanup < VOICE_CLEANUP_INTERVAL:
+                return
+            self._last_cleanup = now
+        
+        cutoff = now - self.voice_retention_hours * 3600
+        removed = 0
+        try:
+            with os.scandir(self.voice_download_path) as entries:
+                for entry in entries:
+                    # Solo i file creati dal listener (anche download interrotti)
+                    if not entry.name.startswith("voice_") or not entry.is_file():
+                        continue
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.remove(entry.path)
+                            removed += 1
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f"⚠️ Impossibile pulire {self.voice_download_path}: {e}")
+            return
+        if removed:
+            logger.info(f"🧹 Eliminati {removed} vocali più vecchi di {self.voice_retention_hours} ore")
+    
     def _transcribe_voice_file(self, file_path: str) -> Optional[str]:
         """
         Trascrive un file vocale usando speech-to-text
@@ -291,53 +996,56 @@ class TelegramListener(BaseListener):
         """
         try:
             # Prova prima con speech_recognition se disponibile
-            try:
-                import speech_recognition as sr
-                
-                recognizer = sr.Recognizer()
-                
-                # Converti OGG in WAV se necessario
-                audio_file = file_path
-                if file_path.endswith('.ogg'):
-                    try:
-                        from pydub import AudioSegment
-                        audio = AudioSegment.from_ogg(file_path)
-                        wav_path = file_path.replace('.ogg', '.wav')
-                        audio.export(wav_path, format="wav")
-                        audio_file = wav_path
-                    except ImportError:
-                        logger.warning("⚠️ pydub non disponibile, provo con file OGG originale")
-                
-                # Trascrivi
-                with sr.AudioFile(audio_file) as source:
-                    audio_data = recognizer.record(source)
-                    text = recognizer.recognize_google(audio_data, language='it-IT')
+            if self.transcription_engine in ("auto", "google"):
+                try:
+                    import speech_recognition as sr
                     
-                logger.info(f"🎯 Trascrizione completata: '{text[:50]}...'")
-                return text
-                
-            except ImportError:
-                logger.warning("⚠️ speech_recognition non disponibile")
-            except sr.UnknownValueError:
-                logger.warning("⚠️ Impossibile riconoscere l'audio")
-                return "[Audio non riconoscibile]"
-            except sr.RequestError as e:
-                logger.warning(f"⚠️ Errore servizio riconoscimento: {e}")
-                return "[Errore trascrizione]"
+                    recognizer = sr.Recognizer()
+                    
+                    # Converti OGG in WAV se necessario, in memoria senza file aggiuntivi
+                    audio_file = file_path
+                    if file_path.endswith(('.ogg', '.oga')):
+                        try:
+                            from pydub import AudioSegment
+                            audio = AudioSegment.from_ogg(file_path)
+                            audio_file = io.BytesIO()
+                            audio.export(audio_file, format="wav")
+                            audio_file.seek(0)
+                        except ImportError:
+                            logger.warning("⚠️ pydub non disponibile, provo con file OGG originale")
+                    
+                    # Trascrivi
+                    with sr.AudioFile(audio_file) as source:
+                        audio_data = recognizer.record(source)
+                        text = recognizer.recognize_google(audio_data, language=self.transcription_language)
+                        
+                    logger.info(f"🎯 Trascrizione completata: '{text[:50]}...'")
+                    return text
+                    
+                except ImportError:
+                    logger.warning("⚠️ speech_recognition non disponibile")
+                except sr.UnknownValueError:
+                    logger.warning("⚠️ Impossibile riconoscere l'audio")
+                    return "[Audio non riconoscibile]"
+                except sr.RequestError as e:
+                    logger.warning(f"⚠️ Errore servizio riconoscimento: {e}")
+                    return "[Errore trascrizione]"
             
             # Fallback: prova con whisper se disponibile
-            try:
-                import whisper
-                
-                model = whisper.load_model("base")
-                result = model.transcribe(file_path, language="it")
-                text = result["text"].strip()
-                
-                logger.info(f"🎯 Trascrizione Whisper completata: '{text[:50]}...'")
-                return text
-                
-            except ImportError:
-                logger.warning("⚠️ whisper non disponibile")
+            if self.transcription_engine in ("auto", "whisper"):
+                try:
+                    language = self.transcription_language.split("-")[0]
+                    pool = self._get_transcription_pool()
+                    if pool:
+                        text = pool.submit(transcribe_with_whisper, file_path, self.transcription_model, language).result()
+                    else:
+                        text = transcribe_with_whisper(file_path, self.transcription_model, language)
+                    
+                    logger.info(f"🎯 Trascrizione Whisper completata: '{text[:50]}...'")
+                    return text
+                    
+                except ImportError:
+                    logger.warning("⚠️ whisper non disponibile")
             
             # Se nessun metodo funziona
             logger.warning("⚠️ Nessun sistema di trascrizione disponibile")
@@ -347,8 +1055,18 @@ class TelegramListener(BaseListener):
             logger.error(f"❌ Errore trascrizione: {e}")
             return f"[Errore trascrizione: {e}]"
     
-    def _process_update(self, update: Dict[str, Any], config_file: str):
-        """Processa un singolo aggiornamento da Telegram"""
+    def _get_transcription_pool(self) -> Optional[ProcessPoolExecutor]:
+        """Crea al primo utilizzo il pool di processi dedicato alla trascrizione"""
+        if self.transcription_processes <= 0:
+            return None
+        with self._transcription_pool_lock:
+            if self._transcription_pool is None:
+                self._transcription_pool = ProcessPoolExecutor(max_workers=self.transcription_processes)
+                logger.info(f"🎯 Pool di trascrizione avviato con {self.transcription_processes} processi")
+            return self._transcription_pool
+    
+    def _process_update(self, update: Dict[str, Any], config_file: str, group: Optional[List[Dict[str, Any]]] = None):
+        """Processa un singolo aggiornamento da Telegram (o un album, con group)"""
         try:
             # Estrai il messaggio dall'update
             message = update.get("message")
@@ -356,13 +1074,33 @@ class TelegramListener(BaseListener):
                 logger.debug("📭 Update senza messaggio, ignorato")
                 return
             
+            # Applica filtri e instradamento prima di scaricare file o creare il flusso
+            chat = message.get("chat", {})
+            message_type = detect_message_type(message)
+            filter_data = {
+                "telegram_chat_id": str(chat.get("id", "")),
+                "telegram_message_type": message_type
+            }
+            if not self._should_process_message(filter_data):
+                logger.debug(f"🚫 Messaggio filtrato: {message_type} da {filter_data['telegram_chat_id']}")
+                return
+            
+            route = None
+            if self.routes:
+                route = self._match_route(message, chat.get("type", ""), message_type)
+                if route is None:
+                    logger.debug(f"🚫 Nessun route per il messaggio da {filter_data['telegram_chat_id']}")
+                    return
+                config_file = route.config_file or config_file
+            
             # Estrai informazioni dal messaggio
             message_data = self._extract_message_data(message)
-            
-            # Applica filtri
-            if not self._should_process_message(message_data):
-                logger.debug(f"🚫 Messaggio filtrato: {message_data.get('telegram_message_type')} da {message_data.get('telegram_chat_id')}")
-                return
+            message_data["telegram_bot_name"] = self.bot_name
+            message_data["telegram_route"] = route.name if route else ""
+            if group:
+                message_data["telegram_media_group_id"] = str(message.get("media_group_id", ""))
+                message_data["telegram_media_items"] = [media_item(item["message"]) for item in group]
+                message_data["telegram_media_count"] = str(len(group))
             
             logger.info(f"📨 Processando messaggio da {message_data.get('telegram_user_first_name', 'Unknown')} ({message_data.get('telegram_chat_id')})")
             
@@ -372,6 +1110,15 @@ class TelegramListener(BaseListener):
         except Exception as e:
             logger.error(f"❌ Errore nel processare update: {e}")
     
+    def _match_route(self, message: Dict[str, Any], chat_type: str, message_type: str) -> Optional[MessageRoute]:
+        """Restituisce il primo route che corrisponde al messaggio"""
+        text = message.get("text") or message.get("caption") or ""
+        command = parse_command(text)
+        for route in self.routes:
+            if route.matches(text, command, chat_type, message_type):
+                return route
+        return None
+    
     def _extract_message_data(self, message: Dict[str, Any]) -> Dict[str, Any]:
         """Estrae i dati dal messaggio Telegram e li formatta per il workflow"""
         chat = message.get("chat", {})
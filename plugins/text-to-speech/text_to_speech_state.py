@@ -4,6 +4,7 @@ import json
 import os
 from datetime import datetime
 from .base_state import BaseState
+from . import http_client
 
 logger = logging.getLogger(__name__)
 
@@ -85,7 +86,7 @@ class TextToSpeechState(BaseState):
             logger.debug(f"Testo da convertire: {text[:100]}{'...' if len(text) > 100 else ''}")
             
             # Effettua la chiamata POST all'API ElevenLabs
-            response = requests.post(api_url, json=payload, headers=headers)
+            response = http_client.post(api_url, json=payload, headers=headers)
             response.raise_for_status()
             
             # Salva il file audio
@@ -7,11 +7,260 @@ import requests
 import logging
 import time
 import json
-from typing import Dict, Any, Optional
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Callable, Tuple, List
 from flow.states.base_state import BaseState
+from . import http_client
 
 logger = logging.getLogger(__name__)
 
+# Database condiviso dai processi per gli access token, nella directory dell'utente
+# (senza una home, ad esempio in alcuni container, la cache è solo in memoria)
+_HOME = os.path.expanduser("~")
+DEFAULT_TOKEN_CACHE = os.path.join(_HOME, ".cache", "intellyhub", "wechat-tokens.db") if _HOME != "~" else None
+# Secondi prima della scadenza in cui il token viene rinnovato
+TOKEN_REFRESH_MARGIN = 300
+# Richiesta di gettoken: timeout (connessione, lettura), ripetizioni e attesa massima tra due tentativi
+TOKEN_FETCH_TIMEOUT = (5, 30)
+TOKEN_FETCH_RETRIES = 2
+TOKEN_FETCH_MAX_BACKOFF = 5
+# Durata massima del rinnovo in corso da parte di un processo: più lunga del caso peggiore
+# della richiesta, così un altro processo non rinnova lo stesso token in parallelo
+TOKEN_LEASE_SECONDS = (sum(TOKEN_FETCH_TIMEOUT) + TOKEN_FETCH_MAX_BACKOFF) * (TOKEN_FETCH_RETRIES + 1)
+TOKEN_POLL_INTERVAL = 0.2
+# Access token non valido o scaduto
+INVALID_TOKEN_CODES = (40014, 42001)
+# Destinatari massimi per chiamata a message/send
+RECIPIENT_LIMITS = {
+    'touser': 1000,
+    'toparty': 100,
+    'totag': 100
+}
+# Campi della risposta con i destinatari non raggiunti
+INVALID_RECIPIENT_FIELDS = ('invaliduser', 'invalidparty', 'invalidtag', 'unlicenseduser')
+# Campi del risultato con i destinatari dei blocchi non inviati
+FAILED_RECIPIENT_FIELDS = {
+    'touser': 'failed_users',
+    'toparty': 'failed_parties',
+    'totag': 'failed_tags'
+}
+# Campi del risultato riportati nell'output dello stato
+REPORT_FIELDS = (
+    INVALID_RECIPIENT_FIELDS
+    + ('msgids', 'batches', 'failed_batches')
+    + tuple(FAILED_RECIPIENT_FIELDS.values())
+)
+
+
+class TokenCache:
+    """
+    Cache degli access token WeChat Work condivisa da stati, thread e processi.
+    
+    I token sono indicizzati per corp_id e secret (di cui si salva solo l'hash) e
+    conservati in memoria e in un database SQLite. Il rinnovo è single-flight: nel
+    processo un lock per chiave, tra processi un lease nel database; chi non rinnova
+    attende il nuovo token o, durante il rinnovo anticipato, usa quello ancora valido.
+    Senza path la cache è solo in memoria.
+    """
+    
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._memory: Dict[str, Tuple[str, float]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+            self._secure_file(path)
+            self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            with self._lock:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS tokens ("
+                    "cache_key TEXT PRIMARY KEY, access_token TEXT, "
+                    "expires_at REAL NOT NULL DEFAULT 0, lease_until REAL NOT NULL DEFAULT 0)"
+                )
+    
+    @staticmethod
+    def _secure_file(path: str):
+        """
+        Crea il database se non esiste e verifica che sia leggibile solo dal proprietario.
+        
+        Il file contiene access token in chiaro: non si seguono link simbolici, un file
+        di un altro utente viene rifiutato e i permessi troppo ampi vengono ridotti a 0600.
+        """
+        fd = os.open(path, os.O_CREAT | os.O_RDWR | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            info = os.fstat(fd)
+            if hasattr(os, "getuid") and info.st_uid != os.getuid():
+                raise PermissionError(f"Il database dei token {path} appartiene a un altro utente")
+            if info.st_mode & 0o077 and hasattr(os, "fchmod"):
+                os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+    
+    @staticmethod
+    def cache_key(corp_id: str, corp_secret: str) -> str:
+        return hashlib.sha256(f"{corp_id}:{corp_secret}".encode("utf-8")).hexdigest()
+    
+    def get(self, corp_id: str, corp_secret: str, fetch: Callable[[], Tuple[str, int]],
+            margin: float = TOKEN_REFRESH_MARGIN) -> str:
+        """
+        Restituisce un access token valido, rinnovandolo se necessario.
+        
+        fetch richiede un nuovo token e restituisce (token, expires_in); viene chiamata
+        da un solo chiamante alla volta per chiave, anche tra processi diversi.
+        """
+        key = self.cache_key(corp_id, corp_secret)
+        token, expires_at = self._memory.get(key, (None, 0))
+        if token and time.time() < expires_at - margin:
+            return token
+        
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        # Con un token ancora valido non si attende chi sta già rinnovando
+        still_valid = token and time.time() < expires_at
+        if not key_lock.acquire(blocking=not still_valid):
+            return token
+        try:
+            token, expires_at = self._memory.get(key, (None, 0))
+            if token and time.time() < expires_at - margin:
+                return token
+            if self._conn is not None:
+                stored = self._acquire(key, margin)
+                if stored:
+                    self._memory[key] = stored
+                    return stored[0]
+            
+            try:
+                logger.debug("🔑 Rinnovo access token WeChat Work")
+                token, expires_in = fetch()
+            except Exception:
+                self._release(key)
+                raise
+            expires_at = time.time() + expires_in
+            self._memory[key] = (token, expires_at)
+            self._store(key, token, expires_at)
+            return token
+        finally:
+            key_lock.release()
+    
+    def invalidate(self, corp_id: str, corp_secret: str, token: str):
+        """Scarta un token rifiutato dall'API, se nel frattempo non è già stato sostituito"""
+        key = self.cache_key(corp_id, corp_secret)
+        if self._memory.get(key, (None, 0))[0] == token:
+            self._memory.pop(key, None)
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE tokens SET expires_at = 0 WHERE cache_key = ? AND access_token = ?", (key, token)
+                )
+    
+    def _acquire(self, key: str, margin: float) -> Optional[Tuple[str, float]]:
+        """
+        Legge il token dal database o ottiene il lease per rinnovarlo.
+        
+        Restituisce (token, scadenza) se un token utilizzabile è disponibile, None se il
+        chiamante ha ottenuto il lease e deve richiedere un nuovo token.
+        """
+        while True:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self._conn.execute(
+                        "SELECT access_token, expires_at, lease_until FROM tokens WHERE cache_key = ?", (key,)
+                    ).fetchone()
+                    now = time.time()
+                    token, expires_at, lease_until = row or (None, 0, 0)
+                    if token and now < expires_at - margin:
+                        self._conn.execute("COMMIT")
+                        return token, expires_at
+                    if lease_until <= now:
+                        self._conn.execute("INSERT OR IGNORE INTO tokens (cache_key) VALUES (?)", (key,))
+                        self._conn.execute(
+                            "UPDATE tokens SET lease_until = ? WHERE cache_key = ?", (now + TOKEN_LEASE_SECONDS, key)
+                        )
+                        self._conn.execute("COMMIT")
+                        return None
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            # Un altro processo sta rinnovando: si usa il token ancora valido o si attende
+            if token and now < expires_at:
+                return token, expires_at
+            time.sleep(TOKEN_POLL_INTERVAL)
+    
+    def _store(self, key: str, token: str, expires_at: float):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE tokens SET access_token = ?, expires_at = ?, lease_until = 0 WHERE cache_key = ?",
+                    (token, expires_at, key)
+                )
+    
+    def _release(self, key: str):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute("UPDATE tokens SET lease_until = 0 WHERE cache_key = ?", (key,))
+
+
+class RateLimiter:
+    """Distribuisce le chiamate nel tempo: al massimo rate chiamate al secondo"""
+    
+    def __init__(self, rate: float):
+        self.interval = 1.0 / float(rate)
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(corp_id: str, agent_id: str, rate: float) -> RateLimiter:
+    """Limite di invio condiviso da tutti gli stati del processo che usano la stessa applicazione e lo stesso rate"""
+    key = f"{corp_id}:{agent_id}:{float(rate)}"
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = _rate_limiters[key] = RateLimiter(rate)
+        return limiter
+
+
+_token_caches: Dict[str, TokenCache] = {}
+_token_caches_lock = threading.Lock()
+
+
+def get_token_cache(path: Optional[str] = DEFAULT_TOKEN_CACHE) -> TokenCache:
+    """Cache dei token per il percorso indicato, condivisa da tutti gli stati del processo"""
+    key = os.path.abspath(path) if path else ""
+    with _token_caches_lock:
+        cache = _token_caches.get(key)
+        if cache is None:
+            try:
+                cache = TokenCache(path or None)
+            except (OSError, sqlite3.Error) as e:
+                # Home di sola lettura, di un altro utente, disco pieno...: lo stato deve funzionare comunque
+                logger.warning(f"⚠️ Cache dei token {path} non utilizzabile ({e}), uso la cache in memoria")
+                cache = _token_caches.get("") or TokenCache(None)
+                _token_caches[""] = cache
+            _token_caches[key] = cache
+        return cache
+
 class WeChatState(BaseState):
     """
     Stato per inviare messaggi tramite API WeChat Work
@@ -23,12 +272,13 @@ class WeChatState(BaseState):
       corp_id: "{WECHAT_CORP_ID}"
       corp_secret: "{WECHAT_CORP_SECRET}"
       agent_id: "{WECHAT_AGENT_ID}"
-      to_user: "{WECHAT_USER_ID}"  # opzionale
-      to_party: "1"                # opzionale
-      to_tag: "tag1"               # opzionale
+      to_user: "{WECHAT_USER_ID}"  # opzionale, anche lista o "a|b|c"
+      to_party: "1"                # opzionale, anche lista
+      to_tag: "tag1"               # opzionale, anche lista
       message: "Testo del messaggio"
       message_type: "text"         # text, textcard, markdown
       safe: 0                      # 0=normale, 1=confidenziale
+      token_cache: "/var/lib/intellyhub/wechat-tokens.db"  # opzionale
       output: "wechat_result"      # opzionale
       success_transition: next_state
       error_transition: handle_error
@@ -51,8 +301,13 @@ class WeChatState(BaseState):
         self.message = self.state_config.get('message', '')
         self.message_type = self.state_config.get('message_type', 'text')
         self.safe = self.state_config.get('safe', 0)
-        self._access_token = None
-        self._token_expires_at = 0
+        # Access token condivisi tra stati e processi (false = solo in memoria)
+        token_cache = self.state_config.get('token_cache', DEFAULT_TOKEN_CACHE)
+        self.token_cache = get_token_cache(token_cache or None)
+        self.token_refresh_margin = self.state_config.get('token_refresh_margin', TOKEN_REFRESH_MARGIN)
+        # Invio a molti destinatari: blocchi inviati in parallelo entro il limite di chiamate
+        self.send_concurrency = self.state_config.get('send_concurrency', 4)
+        self.send_rate = self.state_config.get('send_rate', 10)
         
     def execute(self, variables: Dict[str, Any]) -> str:
         """
@@ -69,9 +324,9 @@ class WeChatState(BaseState):
             resolved_corp_id = self.format_recursive(self.corp_id, variables)
             resolved_corp_secret = self.format_recursive(self.corp_secret, variables)
             resolved_agent_id = self.format_recursive(self.agent_id, variables)
-            resolved_to_user = self.format_recursive(self.to_user, variables)
-            resolved_to_party = self.format_recursive(self.to_party, variables)
-            resolved_to_tag = self.format_recursive(self.to_tag, variables)
+            users = self._resolve_recipients(self.to_user, variables)
+            parties = self._resolve_recipients(self.to_party, variables)
+            tags = self._resolve_recipients(self.to_tag, variables)
             resolved_message = self.format_recursive(self.message, variables)
             
             logger.info(f"💬 Invio messaggio WeChat Work tramite agente {resolved_agent_id}")
@@ -82,17 +337,40 @@ class WeChatState(BaseState):
                 logger.error("❌ Impossibile ottenere access token WeChat Work")
                 return self._handle_error(variables, "Impossibile ottenere access token")
             
-            # Prepara il messaggio
-            message_data = self._prepare_message(
-                resolved_agent_id,
-                resolved_to_user,
-                resolved_to_party,
-                resolved_to_tag,
-                resolved_message
-            )
+            # Prepara i messaggi: un blocco di destinatari per chiamata
+            batches = self._recipient_batches(users, parties, tags)
+            messages = [
+                self._prepare_message(
+                    resolved_agent_id,
+                    '|'.join(batch_users),
+                    '|'.join(batch_parties),
+                    '|'.join(batch_tags),
+                    resolved_message
+                )
+                for batch_users, batch_parties, batch_tags in batches
+            ]
+            
+            # Invia i messaggi
+            def send(message_data):
+                return self._send_with_token(resolved_corp_id, resolved_corp_secret, access_token, message_data)
             
-            # Invia il messaggio
-            result = self._send_message(access_token, message_data)
+            if len(messages) == 1:
+                result = send(messages[0])
+            else:
+                logger.info(f"📦 Invio a {len(users)} utenti, {len(parties)} dipartimenti e {len(tags)} tag "
+                            f"in {len(messages)} blocchi")
+                limiter = get_rate_limiter(resolved_corp_id, resolved_agent_id, self.send_rate)
+                
+                def send_batch(message_data):
+                    limiter.wait()
+                    try:
+                        return send(message_data)
+                    except Exception as e:
+                        logger.error(f"❌ Errore nell'invio di un blocco WeChat Work: {e}")
+                        return {'errcode': -1, 'errmsg': str(e)}
+                
+                with ThreadPoolExecutor(max_workers=min(self.send_concurrency, len(messages))) as executor:
+                    result = self._merge_results(messages, list(executor.map(send_batch, messages)))
             
             if result.get('errcode') == 0:
                 logger.info(f"✅ Messaggio WeChat Work inviato con successo")
@@ -108,6 +386,10 @@ class WeChatState(BaseState):
                         'response_code': result.get('response_code'),
                         'timestamp': int(time.time())
                     }
+                    # Destinatari non raggiunti e dettaglio dei blocchi
+                    for field in REPORT_FIELDS:
+                        if field in result:
+                            variables[output_key][field] = result[field]
                     
                 return self.state_config.get('success_transition', 
                                            self.state_config.get('transition'))
@@ -128,42 +410,146 @@ class WeChatState(BaseState):
             logger.error(f"❌ Errore inaspettato WeChat Work: {e}")
             return self._handle_error(variables, f"Errore inaspettato: {e}")
     
-    def _get_access_token(self, corp_id: str, corp_secret: str) -> Optional[str]:
+    def _resolve_recipients(self, recipients: Any, variables: Dict[str, Any]) -> List[str]:
+        """
+        Restituisce la lista dei destinatari senza duplicati.
+        
+        Accetta una stringa con ID separati da |, una lista nella configurazione o il
+        riferimento a una variabile ("{user_ids}") che contiene una lista.
+        """
+        if isinstance(recipients, str):
+            match = re.fullmatch(r'\{(\w+)\}', recipients.strip())
+            if match and isinstance(variables.get(match.group(1)), (list, tuple, set)):
+                recipients = variables[match.group(1)]
+            else:
+                recipients = str(self.format_recursive(recipients, variables)).split('|')
+        elif recipients is None:
+            recipients = []
+        elif not isinstance(recipients, (list, tuple, set)):
+            recipients = [recipients]
+        
+        resolved = []
+        seen = set()
+        for recipient in recipients:
+            recipient = str(self.format_recursive(recipient, variables)).strip()
+            if recipient and recipient not in seen:
+                seen.add(recipient)
+                resolved.append(recipient)
+        return resolved
+    
+    @staticmethod
+    def _recipient_batches(users: List[str], parties: List[str], tags: List[str]) -> List[Tuple[List[str], List[str], List[str]]]:
+        """
+        Divide i destinatari in blocchi entro i limiti di una chiamata a message/send.
+        
+        Il blocco i contiene l'i-esima porzione di utenti, dipartimenti e tag, così il
+        numero di chiamate è quello richiesto dalla lista più lunga.
         """
-        Ottiene l'access token per l'API WeChat Work
+        # Con @all gli altri destinatari vengono ignorati dall'API
+        if '@all' in users:
+            return [(['@all'], [], [])]
+        
+        def chunks(items: List[str], size: int) -> List[List[str]]:
+            return [items[start:start + size] for start in range(0, len(items), size)]
+        
+        user_chunks = chunks(users, RECIPIENT_LIMITS['touser'])
+        party_chunks = chunks(parties, RECIPIENT_LIMITS['toparty'])
+        tag_chunks = chunks(tags, RECIPIENT_LIMITS['totag'])
+        count = max(len(user_chunks), len(party_chunks), len(tag_chunks), 1)
+        return [
+            (
+                user_chunks[index] if index < len(user_chunks) else [],
+                party_chunks[index] if index < len(party_chunks) else [],
+                tag_chunks[index] if index < len(tag_chunks) else []
+            )
+            for index in range(count)
+        ]
+    
+    @staticmethod
+    def _merge_results(messages: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
-        # Controlla se il token è ancora valido
-        if self._access_token and time.time() < self._token_expires_at:
-            return self._access_token
+        Unisce le risposte dei blocchi in un unico risultato.
         
+        errcode è 0 solo se tutti i blocchi sono stati inviati; i destinatari non validi
+        di tutti i blocchi vengono riuniti negli stessi campi restituiti dall'API e quelli
+        dei blocchi falliti in failed_users, failed_parties e failed_tags, così da poterli
+        inviare di nuovo.
+        """
+        failed = [result for result in results if result.get('errcode') != 0]
+        merged = {
+            'errcode': failed[0].get('errcode') if failed else 0,
+            'errmsg': failed[0].get('errmsg') if failed else 'ok',
+            'msgid': next((result['msgid'] for result in results if result.get('msgid')), None),
+            'msgids': [result['msgid'] for result in results if result.get('msgid')],
+            'response_code': next((result['response_code'] for result in results if result.get('response_code')), None),
+            'batches': len(results),
+            'failed_batches': len(failed)
+        }
+        for field in INVALID_RECIPIENT_FIELDS:
+            values = [result[field] for result in results if result.get(field)]
+            if values:
+                merged[field] = '|'.join(values)
+        failed_messages = [message for message, result in zip(messages, results) if result.get('errcode') != 0]
+        for recipient_field, field in FAILED_RECIPIENT_FIELDS.items():
+            values = [message[recipient_field] for message in failed_messages if message.get(recipient_field)]
+            if values:
+                merged[field] = '|'.join(values)
+        return merged
+    
+    def _send_with_token(self, corp_id: str, corp_secret: str, access_token: str,
+                         message_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Invia il messaggio e, se l'API rifiuta il token, ripete l'invio con un token nuovo
+        """
+        result = self._send_message(access_token, message_data)
+        if result.get('errcode') in INVALID_TOKEN_CODES:
+            # Token revocato o scaduto prima del previsto: se ne richiede uno nuovo
+            logger.warning("🔑 Access token WeChat Work non valido, rinnovo")
+            self.token_cache.invalidate(corp_id, corp_secret, access_token)
+            access_token = self._get_access_token(corp_id, corp_secret)
+            if access_token:
+                result = self._send_message(access_token, message_data)
+        return result
+    
+    def _get_access_token(self, corp_id: str, corp_secret: str) -> Optional[str]:
+        """
+        Ottiene l'access token per l'API WeChat Work dalla cache condivisa
+        """
         try:
-            url = f"{self.BASE_URL}/gettoken"
-            params = {
-                'corpid': corp_id,
-                'corpsecret': corp_secret
-            }
-            
-            logger.debug("🔑 Richiesta access token WeChat Work")
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
-            
-            if result.get('errcode') == 0:
-                self._access_token = result.get('access_token')
-                expires_in = result.get('expires_in', 7200)  # Default 2 ore
-                self._token_expires_at = time.time() + expires_in - 300  # Rinnova 5 min prima
-                
-                logger.debug(f"✅ Access token ottenuto, scade tra {expires_in} secondi")
-                return self._access_token
-            else:
-                logger.error(f"❌ Errore ottenimento token: {result.get('errmsg')} (Code: {result.get('errcode')})")
-                return None
-                
+            return self.token_cache.get(
+                corp_id,
+                corp_secret,
+                lambda: self._fetch_access_token(corp_id, corp_secret),
+                margin=self.token_refresh_margin
+            )
         except Exception as e:
             logger.error(f"❌ Errore nella richiesta del token: {e}")
             return None
     
+    def _fetch_access_token(self, corp_id: str, corp_secret: str) -> Tuple[str, int]:
+        """
+        Richiede un nuovo access token e restituisce (token, durata in secondi)
+        """
+        url = f"{self.BASE_URL}/gettoken"
+        params = {
+            'corpid': corp_id,
+            'corpsecret': corp_secret
+        }
+        
+        logger.debug("🔑 Richiesta access token WeChat Work")
+        response = http_client.get(url, params=params, timeout=TOKEN_FETCH_TIMEOUT,
+                                   retries=TOKEN_FETCH_RETRIES, max_backoff=TOKEN_FETCH_MAX_BACKOFF)
+        response.raise_for_status()
+        
+        result = response.json()
+        
+        if result.get('errcode') != 0:
+            raise ValueError(f"{result.get('errmsg')} (Code: {result.get('errcode')})")
+        
+        expires_in = result.get('expires_in', 7200)  # Default 2 ore
+        logger.debug(f"✅ Access token ottenuto, scade tra {expires_in} secondi")
+        return result.get('access_token'), expires_in
+    
     def _prepare_message(self, agent_id: str, to_user: str, to_party: str, 
                         to_tag: str, message: str) -> Dict[str, Any]:
         """
@@ -221,7 +607,7 @@ class WeChatState(BaseState):
         
         logger.debug(f"📤 Invio messaggio: {json.dumps(message_data, ensure_ascii=False)}")
         
-        response = requests.post(
+        response = http_client.post(
             url, 
             params=params, 
             json=message_data, 
@@ -250,6 +636,9 @@ class WeChatState(BaseState):
                     'errcode': api_result.get('errcode'),
                     'errmsg': api_result.get('errmsg')
                 })
+                for field in REPORT_FIELDS:
+                    if field in api_result:
+                        error_data[field] = api_result[field]
             
             variables[output_key] = error_data
         